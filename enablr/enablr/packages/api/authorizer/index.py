@@ -3,7 +3,12 @@ import os
 import jwt
 import re
 import boto3
+import hashlib
+import time
 from base64 import b64decode
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from token_cache import TTLCache
 
 from aws_lambda_powertools.utilities.data_classes import event_source
 from aws_lambda_powertools.utilities.data_classes.api_gateway_authorizer_event import (
@@ -15,13 +20,66 @@ from aws_lambda_powertools.utilities.data_classes.api_gateway_authorizer_event i
 
 # SSM is AWS systems manager, it's where we store encrypted secrets so they don't sit in our code.
 ssm_client = boto3.client('ssm')
+dynamodb_client = boto3.client('dynamodb')
+
+REGISTRATION_TABLE_NAME = os.environ['REGISTRATION_TABLE_NAME']
 
 public_ssm_parameter = ssm_client.get_parameter(
     Name=os.environ['JWT_PUBLIC_SIGNING_KEY'],
     WithDecryption=True
 )
 
-public_key = public_ssm_parameter['Parameter']['Value']
+# Parse the PEM once when the lambda starts rather than on every request
+public_key = load_pem_public_key(
+    public_ssm_parameter['Parameter']['Value'].encode())
+
+# Devices poll with the same token every few seconds, so once a token's signature has been checked the result is kept for a while.
+# Keyed by a digest so the tokens themselves aren't held in memory
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '1024'))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', '300'))
+verified_tokens = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+# Registrations are kept for a short time only, it's how long a revoked device can keep going for
+REGISTRATION_CACHE_TTL = int(os.environ.get('REGISTRATION_CACHE_TTL', '30'))
+registrations = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=REGISTRATION_CACHE_TTL)
+
+# How often (in seconds) each container logs the cache hit and miss counts
+CACHE_STATS_INTERVAL = int(os.environ.get('CACHE_STATS_INTERVAL', '300'))
+cache_stats_logged_at = None
+
+
+def log_cache_stats():
+    '''Log the cache counters on the first request a container handles and then every CACHE_STATS_INTERVAL seconds,
+    so a request answered from the caches doesn't have to write anything'''
+    global cache_stats_logged_at
+    now = time.monotonic()
+    if cache_stats_logged_at is not None and now - cache_stats_logged_at < CACHE_STATS_INTERVAL:
+        return
+
+    cache_stats_logged_at = now
+    print(f'token cache {verified_tokens.stats()} registration cache {registrations.stats()}')
+
+
+def get_individual_id(registration_id):
+    '''The individual a registration gives access to, or an empty string when the registration doesn't exist or has been revoked'''
+    individual_id = registrations.get(registration_id)
+    if individual_id is not None:
+        return individual_id
+
+    response = dynamodb_client.get_item(
+        TableName=REGISTRATION_TABLE_NAME,
+        Key={'registration_id': {'S': registration_id}},
+        ProjectionExpression='individual_id, revoked'
+    )
+
+    registration = response.get('Item')
+    if registration is None or 'revoked' in registration:
+        individual_id = ''
+    else:
+        individual_id = registration['individual_id']['S']
+
+    registrations.put(registration_id, individual_id)
+    return individual_id
 
 
 def decode_token(jwt_token):
@@ -34,20 +92,28 @@ def decode_token(jwt_token):
     if len(jwt_parts) != 2:
         return None
 
+    token_digest = hashlib.sha256(jwt_parts[1].encode()).hexdigest()
+    decoded_jwt = verified_tokens.get(token_digest)
+
     # Verify the JWT using the public key
-    try:
-        decoded_jwt = jwt.decode(jwt_parts[1], public_key, algorithms='RS256')
-    except jwt.exceptions.DecodeError:
-        return None
+    if decoded_jwt is None:
+        try:
+            decoded_jwt = jwt.decode(
+                jwt_parts[1], public_key, algorithms='RS256')
+        except jwt.exceptions.InvalidTokenError:
+            return None
+
+        verified_tokens.put(token_digest, decoded_jwt)
 
     # Verify that the JWT has the correct claims
     if decoded_jwt.get("registrationId") is None:
         return None
     else:
-        # Pass the registration ID into the context to be used by the API
-        # Further action can be take right here to validate the registration id is valid and not revoked.
+        # Pass the registration ID and the individual it's for into the context to be used by the API.
+        # A revoked registration is still let through with no individual, so the device API can tell the device it's been revoked
         return {
-            'registration_id': decoded_jwt.get("registrationId")
+            'registration_id': decoded_jwt.get("registrationId"),
+            'individual_id': get_individual_id(decoded_jwt.get("registrationId"))
         }
 
 
@@ -55,6 +121,7 @@ def decode_token(jwt_token):
 def lambda_handler(event: APIGatewayAuthorizerRequestEvent, context):
     '''Handler for the authorizer. The context is not used but still needs to be defined.'''
     registration = decode_token(event['authorizationToken'])
+    log_cache_stats()
 
     if registration is None:
         return DENY_ALL_RESPONSE
@@ -13,10 +13,11 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
  See the License for the specific language governing permissions and
  limitations under the License.
 """
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import individual
-import device
 import reminder
 
 from aws_lambda_powertools import Logger, Tracer
@@ -42,66 +43,116 @@ def revoked_response():
     )
 
 
-def valid_registration(registration_details):
-    '''Check if the registration is valid or not'''
-    if (not registration_details) or ("revoked" in registration_details):
-        return False
-    return True
+def authorized_individual():
+    '''The individual the device is registered to. The authorizer has already checked the registration,
+    an empty individual means it has been revoked (or no longer exists)'''
+    return app.current_event.request_context.authorizer.get('individual_id')
 
 
 @app.get("/device/individual")
 @tracer.capture_method
 def get_individual_details():
     '''The get method for individual details to return to the device'''
-    registration_id = app.current_event.request_context.authorizer['registration_id']
-    registration_details = device.get_registration_details(registration_id)
+    individual_id = authorized_individual()
 
-    if not valid_registration(registration_details):
+    if not individual_id:
         return revoked_response()
 
-    if registration_details:
-        individual_id = registration_details['individual_id']
+    ind = individual.get_individual_details(individual_id)
+    return ind
 
-        ind = individual.get_individual_details(individual_id)
-        return ind
+
+# How many tasks reminders are fetched at once for the bootstrap
+BOOTSTRAP_WORKERS = 8
+
+
+@app.get("/device/bootstrap")
+@tracer.capture_method
+def get_bootstrap():
+    '''Everything a device needs when it starts, in one call: the individual's details and the reminders for every task.
+    The query string can take a beginning (default two hours ago, like the app uses) and an until timestamp'''
+    individual_id = authorized_individual()
+
+    if not individual_id:
+        return revoked_response()
+
+    beginning = app.current_event.get_query_string_value(
+        'beginning', str(int(time.time()) - (60 * 60 * 2)))
+    until = app.current_event.get_query_string_value('until')
+
+    ind = individual.get_individual_details(individual_id)
+    task_ids = [task['task_id'] for task in ind['tasks']]
+
+    def task_reminders(task_id):
+        response, _ = reminder.get_reminders_from_date(
+            f'{individual_id}-{task_id}', task_id, beginning, until=until)
+        return response
+
+    # Each task is a separate query, so they are run side by side rather than one after the other
+    try:
+        with ThreadPoolExecutor(max_workers=BOOTSTRAP_WORKERS) as executor:
+            reminders = dict(zip(task_ids, executor.map(task_reminders, task_ids)))
+    except ValueError:
+        return Response(
+            status_code=400,
+            content_type=content_types.TEXT_PLAIN,
+            body="Invalid beginning or until",
+        )
+
+    return {**ind, 'reminders': reminders}
 
 
 @app.get("/device/reminders/<task_id>/<beginning>")
 @tracer.capture_method
 def get_reminders_from_date(task_id: str, beginning: str):
-    '''Using a beginning date, get all future reminders'''
-    registration_id = app.current_event.request_context.authorizer['registration_id']
-    registration_details = device.get_registration_details(registration_id)
+    '''Using a beginning date, get all future reminders.
+    The query string can take an until timestamp, a limit on how many to return and the cursor from the previous page'''
+    individual_id = authorized_individual()
 
-    if not valid_registration(registration_details):
+    if not individual_id:
         return revoked_response()
 
-    if registration_details:
-        individual_id = registration_details['individual_id']
-        reminder_id = f'{individual_id}-{task_id}'
-        response = reminder.get_reminders_from_date(reminder_id, beginning)
-        return {'reminders': response}
+    reminder_id = f'{individual_id}-{task_id}'
+    try:
+        response, cursor = reminder.get_reminders_from_date(
+            reminder_id, task_id, beginning,
+            until=app.current_event.get_query_string_value('until'),
+            limit=app.current_event.get_query_string_value('limit'),
+            cursor=app.current_event.get_query_string_value('cursor'))
+    except (reminder.InvalidCursor, ValueError):
+        return Response(
+            status_code=400,
+            content_type=content_types.TEXT_PLAIN,
+            body="Invalid until, limit or cursor",
+        )
+
+    return {'reminders': response, 'cursor': cursor}
 
 
 @app.post("/device/update-reminder/<task_id>")
 @tracer.capture_method
 def post_update_reminder(task_id: str):
     '''This method is used to update a reminder, marking it as complete and optionally adding a note'''
-    registration_id = app.current_event.request_context.authorizer['registration_id']
-    registration_details = device.get_registration_details(registration_id)
+    individual_id = authorized_individual()
 
-    if not valid_registration(registration_details):
+    if not individual_id:
         return revoked_response()
 
-    if registration_details:
-        details: dict = app.current_event.json_body
-        individual_id = registration_details['individual_id']
-        due = details['due']
-        note = details['note']
-        reminder_id = f'{individual_id}-{task_id}'
+    details: dict = app.current_event.json_body
+    due = details['due']
+    note = details['note']
+    reminder_id = f'{individual_id}-{task_id}'
 
+    try:
         response = reminder.update_reminder(reminder_id, due, note)
-        return response
+    except reminder.ReminderNotFound:
+        return Response(
+            status_code=404,
+            content_type=content_types.TEXT_PLAIN,
+            body="No reminder is due then",
+        )
+
+    return response
 
 
 @logger.inject_lambda_context(correlation_id_path=correlation_paths.API_GATEWAY_REST, log_event=True)
@@ -1,6 +1,7 @@
 import json
 import os
 import boto3
+import base64
 import datetime
 
 REMINDER_TABLE_NAME = os.environ['REMINDER_TABLE_NAME']
@@ -11,46 +12,205 @@ dynamodb_resource = boto3.resource('dynamodb')
 reminder_table = dynamodb_resource.Table(REMINDER_TABLE_NAME)
 
 
-def get_reminders_from_date(reminder_id, beginning):
-    '''Using a beginning date, get all reminders beyond for a specific reminderID'''
-    beginning_int = int(beginning)
+# Reminders can be stored a day to an item, keyed by when the day starts. A local day is never longer than 25 hours
+# (the day clocks go back) so the day a time falls in always starts less than this before it, whichever timezone the individual is in
+DAY_ITEM_LOOKBACK = 25 * 3600
+
+
+def expand_reminders(items):
+    '''Turn stored items into one dynamo typed reminder each. Day items (with slots) are split into a reminder per slot'''
+    for item in items:
+        if 'slots' not in item:
+            yield item
+            continue
+
+        for slot in item['slots']['L']:
+            yield {'reminder_id': item['reminder_id'], **slot['M']}
+
+
+# The most reminders a device can ask for in one page
+MAX_PAGE_SIZE = 500
+
+# Only the fields sent back to the device are read, older items still carry the whole task on them
+REMINDER_PROJECTION = {
+    'ProjectionExpression': '#r, #d, #c, #n, #s',
+    'ExpressionAttributeNames': {'#r': 'reminder_id', '#d': 'due', '#c': 'completed', '#n': 'note', '#s': 'slots'}
+}
+
+
+class InvalidCursor(Exception):
+    '''The cursor sent by the device couldn't be read'''
+
+
+class ReminderNotFound(Exception):
+    '''There is no reminder due at the time the device sent'''
+
+
+def to_timestamp(value):
+    '''Read a timestamp from the path or query string, which can come from javascript in milliseconds'''
+    timestamp = int(value)
 
     # difference between python and js timestamps. Arbitrary number with just 1000 x more digits than a python timestamp
-    if beginning_int > 167372820000:
-        beginning_int = round(beginning_int/1000, 0)
+    if timestamp > 167372820000:
+        timestamp = round(timestamp/1000)
+
+    return timestamp
+
+
+def encode_cursor(due):
+    '''The cursor is just the last reminder sent, but the device shouldn't rely on that so it's kept opaque'''
+    return base64.urlsafe_b64encode(json.dumps({'after': due}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['after'])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor(cursor)
 
+
+def get_containing_day(reminder_id, timestamp, **kwargs):
+    '''Get the day item a time falls in, or None when reminders around then are stored one per item.
+    The day started at or before the time, so it's the last item up to it. Only that one item is read, which is
+    all there is to read when reminders are stored one per item. On the day day items are turned on, a reminder already
+    stored on its own earlier that day comes after the day's key and hides it until the next day'''
     response = dynamodb.query(
         TableName=REMINDER_TABLE_NAME,
-        KeyConditionExpression='reminder_id = :reminder_id AND due > :due',
+        KeyConditionExpression='reminder_id = :reminder_id AND due BETWEEN :since AND :due',
         ExpressionAttributeValues={
             ':reminder_id': {'S': reminder_id},
-            ':due': {'N': str(beginning_int)}
-        }
+            ':since': {'N': str(int(timestamp) - DAY_ITEM_LOOKBACK)},
+            ':due': {'N': str(timestamp)}
+        },
+        ScanIndexForward=False,
+        Limit=1,
+        **kwargs
     )
 
+    for item in response['Items']:
+        if 'slots' in item:
+            return item
+
+    return None
+
+
+def get_reminders_from_date(reminder_id, task_id, beginning, until=None, limit=None, cursor=None):
+    '''Using a beginning date, get all reminders beyond for a specific reminderID, optionally only up to until.
+    Reminders only store their keys, the task details come from the individual.
+
+    With a limit at most that many reminders are returned along with a cursor to get the next page from (None on the last page),
+    without one every reminder is returned'''
+    after = decode_cursor(cursor) if cursor else to_timestamp(beginning)
+    until = to_timestamp(until) if until is not None else None
+    if limit is not None:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    if until is not None and until <= after:
+        return [], None
+
+    query_kwargs = {
+        'TableName': REMINDER_TABLE_NAME,
+        'KeyConditionExpression': 'reminder_id = :reminder_id AND due > :due',
+        'ExpressionAttributeValues': {
+            ':reminder_id': {'S': reminder_id},
+            ':due': {'N': str(after)}
+        },
+        **REMINDER_PROJECTION
+    }
+    if until is not None:
+        query_kwargs['KeyConditionExpression'] = 'reminder_id = :reminder_id AND due BETWEEN :due AND :until'
+        query_kwargs['ExpressionAttributeValues'][':until'] = {'N': str(until)}
+    if limit is not None:
+        query_kwargs['Limit'] = limit
+
+    # The rest of the day the beginning falls in, when it's stored as a day item keyed before the beginning
+    day = get_containing_day(reminder_id, after, **REMINDER_PROJECTION)
+    items = [day] if day is not None else []
+
     results = []
+    while True:
+        response = dynamodb.query(**query_kwargs)
+        items.extend(response['Items'])
 
-    for reminder in response['Items']:
-        results.append({
-            'reminder_id': reminder['reminder_id']['S'],
-            'task_id': reminder['task_id']['S'],
-            'due': reminder['due']['N'],
-            'completed': reminder['completed']['BOOL'],
-            'note': reminder['note']['S'],
-        })
+        for reminder in expand_reminders(items):
+            due = int(reminder['due']['N'])
+            if due <= after or (until is not None and due > until):
+                continue
+
+            results.append({
+                'reminder_id': reminder['reminder_id']['S'],
+                'task_id': task_id,
+                'due': reminder['due']['N'],
+                'completed': reminder['completed']['BOOL'],
+                'note': reminder['note']['S'],
+            })
+
+        # Keep reading until past the end of the page, so a cursor is only handed back when there is more to come
+        if 'LastEvaluatedKey' not in response or (limit is not None and len(results) > limit):
+            break
+
+        items = []
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
-    return results
+    results.sort(key=lambda reminder: int(reminder['due']))
+
+    next_cursor = None
+    if limit is not None and len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(int(results[-1]['due']))
+
+    return results, next_cursor
+
+
+def find_day_slot(reminder_id, due):
+    '''Find the day item holding a reminder, and the position of the reminder in its slots. Returns None when there isn't one'''
+    day = get_containing_day(reminder_id, due, ProjectionExpression='#d, #s',
+                             ExpressionAttributeNames={'#d': 'due', '#s': 'slots'})
+    if day is None:
+        return None
+
+    for position, slot in enumerate(day['slots']['L']):
+        if int(slot['M']['due']['N']) == int(due):
+            return int(day['due']['N']), position
+
+    return None
 
 
 def update_reminder(reminder_id, due, note):
-    '''Update a reminder in dynamoDB. Currently only marks complete as true, but you could also mark it as false with another param'''
+    '''Update a reminder in dynamoDB. Currently only marks complete as true, but you could also mark it as false with another param.
+    Raises ReminderNotFound when there is no reminder due then'''
+    # Most reminders are stored one per item so that is tried first. The condition stops a missing reminder being created,
+    # and a day item that happens to have the same key (a reminder due right as its day starts) being written over
+    try:
+        reminder_table.update_item(
+            Key={'reminder_id': reminder_id, 'due': due},
+            # Dropping pending_reminder_id takes the reminder out of the sparse pending index
+            UpdateExpression="set note=:n, completed=:c remove pending_reminder_id",
+            ConditionExpression="attribute_exists(reminder_id) AND attribute_not_exists(slots)",
+            ExpressionAttributeValues={
+                ':n': note,
+                ':c': True,
+            })
+
+        return {"reminder_id": reminder_id}
+    except reminder_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+    day_slot = find_day_slot(reminder_id, due)
+    if day_slot is None:
+        raise ReminderNotFound(due)
+
+    day_start, position = day_slot
+    # Only this slot is touched, and only if it still holds the same reminder, so completing one reminder
+    # can't overwrite another reminder in the same day
     reminder_table.update_item(
-        Key={'reminder_id': reminder_id, 'due': due},
-        UpdateExpression="set note=:n, completed=:c",
+        Key={'reminder_id': reminder_id, 'due': day_start},
+        UpdateExpression=f"set slots[{position}].note=:n, slots[{position}].completed=:c",
+        ConditionExpression=f"slots[{position}].due = :due",
         ExpressionAttributeValues={
             ':n': note,
             ':c': True,
-        },
-        ReturnValues="ALL_NEW")
+            ':due': due,
+        })
 
     return {"reminder_id": reminder_id}
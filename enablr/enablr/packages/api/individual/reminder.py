@@ -8,21 +8,59 @@ REMINDER_TABLE_NAME = os.environ['REMINDER_TABLE_NAME']
 
 dynamodb = boto3.client('dynamodb')
 
+# Reminders can be stored a day to an item, keyed by when the day starts. A local day is never longer than 25 hours
+# (the day clocks go back) so the day a time falls in always starts less than this before it, whichever timezone the individual is in
+DAY_ITEM_LOOKBACK = 25 * 3600
+
+
+def expand_reminders(items):
+    '''Turn stored items into one dynamo typed reminder each. Day items (with slots) are split into a reminder per slot'''
+    for item in items:
+        if 'slots' not in item:
+            yield item
+            continue
+
+        for slot in item['slots']['L']:
+            yield {'reminder_id': item['reminder_id'], **slot['M']}
+
+
+def get_containing_day(reminder_id, timestamp):
+    '''Get the day item a time falls in as a list of one, or an empty list when reminders around then are stored one per item.
+    The day started at or before the time, so it's the last item up to it and only that one item is read'''
+    response = dynamodb.query(
+        TableName=REMINDER_TABLE_NAME,
+        KeyConditionExpression='reminder_id = :reminder_id AND due BETWEEN :since AND :due',
+        ExpressionAttributeValues={
+            ':reminder_id': {'S': reminder_id},
+            ':since': {'N': str(int(timestamp) - DAY_ITEM_LOOKBACK)},
+            ':due': {'N': str(int(timestamp))}
+        },
+        ScanIndexForward=False,
+        Limit=1
+    )
+
+    return [item for item in response['Items'] if 'slots' in item]
+
 
 def get_reminders(reminder_id):
     '''The reminder id is a combination of individual_id and task_id, get all reminders for the last month'''
+    since = (datetime.datetime.today() - datetime.timedelta(weeks=4)).timestamp()
+
     response = dynamodb.query(
         TableName=REMINDER_TABLE_NAME,
         KeyConditionExpression='reminder_id = :reminder_id AND due > :due',
         ExpressionAttributeValues={
             ':reminder_id': {'S': reminder_id},
-            ':due': {'N': (str((datetime.datetime.today() - datetime.timedelta(weeks=4)).timestamp()))}
+            ':due': {'N': str(since)}
         }
     )
 
     results = []
 
-    for reminder in response['Items']:
+    for reminder in expand_reminders(get_containing_day(reminder_id, since) + response['Items']):
+        if float(reminder['due']['N']) <= since:
+            continue
+
         results.append({
             'reminder_id': reminder['reminder_id']['S'],
             'due': reminder['due']['N']
@@ -50,7 +88,10 @@ def get_reminders_from_date(reminder_id, beginning):
 
     results = []
 
-    for reminder in response['Items']:
+    for reminder in expand_reminders(get_containing_day(reminder_id, beginning_int) + response['Items']):
+        if int(reminder['due']['N']) <= beginning_int:
+            continue
+
         results.append({
             'reminder_id': reminder['reminder_id']['S'],
             'due': reminder['due']['N'],
@@ -10,35 +10,21 @@ registration_table = dynamodb_resource.Table(
     os.environ['REGISTRATION_TABLE_NAME'])
 
 
-def get_registration_details(registration_id):
-    '''Get the details of the registration code to ensure it's valid.'''
-    batch_keys = {
-        registration_table.name: {
-            'Keys': [{'registration_id': registration_id}]
-        }
-    }
-
-    response = dynamodb_resource.batch_get_item(
-        RequestItems=batch_keys
-    )
-
-    if len(response['Responses'][registration_table.name]) > 0:
-
-        registration = response['Responses'][registration_table.name][0]
-
-        if (registration['expiry'] > datetime.datetime.now().timestamp()) and not ('device_id' in registration.keys()):
-            return registration
-
-
 def register_device(registration_id, device_id, device_name):
-    '''Align a device ID and device name to a registration'''
-    registration_table.update_item(
-        Key={'registration_id': registration_id},
-        UpdateExpression="set device_id=:d, device_name=:n",
-        ExpressionAttributeValues={
-            ':d': device_id,
-            ':n': device_name
-        },
-        ReturnValues="ALL_NEW")
+    '''Align a device ID and device name to a registration.
+    Done as a single conditional update so the registration has to exist, not be expired and not already have a device,
+    two devices using the same code at once can't both get it. Returns None if the registration can't be used'''
+    try:
+        registration_table.update_item(
+            Key={'registration_id': registration_id},
+            UpdateExpression="set device_id=:d, device_name=:n",
+            ConditionExpression="attribute_exists(registration_id) AND expiry > :now AND attribute_not_exists(device_id)",
+            ExpressionAttributeValues={
+                ':d': device_id,
+                ':n': device_name,
+                ':now': math.floor(datetime.datetime.now().timestamp())
+            })
+    except registration_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
 
     return {"registrationId": registration_id}
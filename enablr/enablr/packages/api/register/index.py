@@ -18,6 +18,7 @@ import logging
 import device
 import jwt
 import os
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.logging import correlation_paths
@@ -39,7 +40,9 @@ private_ssm_parameter = ssm_client.get_parameter(
     WithDecryption=True
 )
 
-secret = private_ssm_parameter['Parameter']['Value']
+# Parse the PEM once when the lambda starts rather than on every registration
+secret = load_pem_private_key(
+    private_ssm_parameter['Parameter']['Value'].encode(), password=None)
 
 
 @app.post("/register/device")
@@ -52,10 +55,9 @@ def post_register_device():
     device_name = details['deviceName']
     # TODO: validate inputs
 
-    registration = device.get_registration_details(registration_id)
-    if (registration):
-        response = device.register_device(
-            registration_id, device_id, device_name)
+    response = device.register_device(
+        registration_id, device_id, device_name)
+    if (response):
         token = jwt.encode({
             "registrationId": response['registrationId']}, secret, algorithm='RS256')
         return {"token": token}
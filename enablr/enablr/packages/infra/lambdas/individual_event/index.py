@@ -1,85 +1,187 @@
 import json
 import boto3
 import os
+import time
 import uuid
+import zlib
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
 
 sqs_client = boto3.client('sqs')
 
+# Metrics are written to the logs in CloudWatch embedded metric format at the end of each invocation
+metrics = Metrics(namespace="Enablr", service="individual_event")
+
 # value passed in to the lambda from the infra
 SQS_URL = os.environ['TASK_EVENT_QUEUE_URL']
 
+# send_message_batch takes at most 10 entries and 256 KB of message bodies per call
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+# How many batches are sent at once, and how many times failed entries are resent
+PUBLISH_WORKERS = 4
+PUBLISH_ATTEMPTS = 5
 
-def publish_events(entries):
-    # TODO: test more than 10 tasks
-    response = sqs_client.send_message_batch(
-        QueueUrl=SQS_URL,
-        Entries=entries
-    )
+
+def chunk_entries(entries):
+    '''Split entries into batches that fit in a single send_message_batch call'''
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(entry['MessageBody'].encode())
+        if batch and (len(batch) == MAX_BATCH_ENTRIES or batch_bytes + entry_bytes > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(entry)
+        batch_bytes += entry_bytes
+
+    if batch:
+        yield batch
+
+
+def send_batch(entries):
+    '''Send a batch, resending any entries SQS reports as failed. Returns the latency of each call and how many entries were resent'''
+    latencies = []
+    resent = 0
+    attempt = 1
+    while True:
+        started = time.perf_counter()
+        response = sqs_client.send_message_batch(
+            QueueUrl=SQS_URL,
+            Entries=entries
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        failed = response.get('Failed', [])
+        if not failed:
+            return latencies, resent
+
+        # A sender fault means the entry itself is bad, sending it again won't help
+        sender_faults = [f for f in failed if f['SenderFault']]
+        if sender_faults or attempt >= PUBLISH_ATTEMPTS:
+            raise Exception(f'Failed to publish {len(failed)} reminder events: {failed}')
+
+        failed_ids = {f['Id'] for f in failed}
+        entries = [entry for entry in entries if entry['Id'] in failed_ids]
+        resent += len(entries)
+
+        time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+        attempt += 1
+
+
+def send_lane(entries):
+    '''Send one lanes entries a batch at a time, in order'''
+    return [send_batch(batch) for batch in chunk_entries(entries)]
 
 
-def create_sqs_entry(task_id, individual_id, update_type):
+def publish_events(entries):
+    '''Publish every entry from the invocation, several batches at a time.
+    Messages in the same group have to reach the FIFO queue in order, so each group is kept in a single lane
+    that is sent one batch after another, and only the lanes run in parallel'''
+    lanes = [[] for _ in range(PUBLISH_WORKERS)]
+    for entry in entries:
+        lanes[zlib.crc32(entry['MessageGroupId'].encode()) %
+              PUBLISH_WORKERS].append(entry)
+
+    with ThreadPoolExecutor(max_workers=PUBLISH_WORKERS) as executor:
+        results = list(executor.map(send_lane, [lane for lane in lanes if lane]))
+
+    for lane_results in results:
+        for latencies, resent in lane_results:
+            for latency in latencies:
+                metrics.add_metric(name="PublishLatency",
+                                   unit=MetricUnit.Milliseconds, value=latency)
+            metrics.add_metric(name="PublishRetries",
+                               unit=MetricUnit.Count, value=resent)
+
+    metrics.add_metric(name="MessagesPublished",
+                       unit=MetricUnit.Count, value=len(entries))
+
+
+def create_sqs_entry(individual_id, changes):
+    '''One message carrying every task change for an individual as {task_id: update_type}.
+    The version lets process_reminder_events tell it apart from the old one message per task format'''
     sqs_entry_id = str(uuid.uuid4())
     return {
         'Id': sqs_entry_id,
         'MessageBody': json.dumps({
+            "version": 2,
             "target_type": 'INDIVIDUAL',
             "target_id": individual_id,
-            "task_id": task_id,
-            "update_type": update_type
-        }),
+            "changes": changes
+        }, separators=(',', ':')),
         'MessageDeduplicationId': sqs_entry_id,
-        'MessageGroupId': 'INDIVIDUAL'
+        # Changes for one individual stay in order, while different individuals are processed at the same time.
+        # The scheduled sweep uses its own scheduled-* groups so it never holds up an edit
+        'MessageGroupId': f'individual-{individual_id}'
     }
 
 
+def task_digest(task):
+    '''A canonical digest of a tasks details, so two versions can be compared regardless of key order'''
+    return hashlib.sha256(json.dumps(task['M']['details'], sort_keys=True).encode()).hexdigest()
+
+
+def index_tasks(tasks):
+    '''Map each task_id in a stream image task list to the digest of its details'''
+    return {task['M']['task_id']["S"]: task_digest(task) for task in tasks}
+
+
+@metrics.log_metrics
 def lambda_handler(event, context):
+    metrics.add_metric(name="StreamRecords", unit=MetricUnit.Count,
+                       value=len(event['Records']))
+
+    # Entries from every record are published together at the end so they fill whole batches
+    events = []
     for record in event['Records']:
+        started = time.perf_counter()
         event_name = record['eventName']
         individual_id = record['dynamodb']["Keys"]["individual_id"]["S"]
         new_tasks = []
-        old_tasks: [] = []
+        old_tasks = []
 
         # Different behaviour for different dynamodb events that may enter
 
         if event_name == 'MODIFY':
             new_tasks = record['dynamodb']['NewImage']["tasks"]["L"]
             old_tasks = record['dynamodb']['OldImage']["tasks"]["L"]
-        elif event_name == 'DELETE':
+
+            # Edits that only touched the individuals details (name, colours) don't affect any reminders
+            if new_tasks == old_tasks:
+                metrics.add_metric(name="SkippedRecords",
+                                   unit=MetricUnit.Count, value=1)
+                continue
+        elif event_name == 'REMOVE':
             old_tasks = record['dynamodb']['OldImage']["tasks"]["L"]
         else:
             new_tasks = record['dynamodb']['NewImage']["tasks"]["L"]
 
-        new = []
-        modified = []
-
-        for new_task in new_tasks:
-            existing_task = None
-            for old_task in old_tasks:
-                if new_task['M']['task_id']["S"] == old_task['M']['task_id']["S"]:
-                    existing_task = old_task
-
-            if existing_task is None:
-                new.append(new_task)
-            elif (json.dumps(existing_task['M']['details']) != json.dumps(new_task['M']['details'])):
-                modified.append(new_task)
-
-            if existing_task is not None:
-                # We can assume that it isn't a 'old' task so remove it from the list.
-                old_tasks.remove(existing_task)
-
-        events = []
-        for task in new:
-            events.append(create_sqs_entry(
-                task['M']['task_id']["S"], individual_id, 'CREATE'))
-
-        for task in modified:
-            events.append(create_sqs_entry(
-                task['M']['task_id']["S"], individual_id, 'UPDATE'))
-
-        # Only leftover tasks should be here that need to be deleted.
-        for task in old_tasks:
-            events.append(create_sqs_entry(
-                task['M']['task_id']["S"], individual_id, 'DELETE'))
-                
-        if len(events) > 0:
-            publish_events(events)
+        old = index_tasks(old_tasks)
+        new = index_tasks(new_tasks)
+
+        changes = {}
+        for task_id, digest in new.items():
+            if task_id not in old:
+                changes[task_id] = 'CREATE'
+            elif old[task_id] != digest:
+                changes[task_id] = 'UPDATE'
+
+        # Any task that is only in the old image has been removed
+        for task_id in old:
+            if task_id not in new:
+                changes[task_id] = 'DELETE'
+
+        if changes:
+            events.append(create_sqs_entry(individual_id, changes))
+
+        metrics.add_metric(name="DiffTime", unit=MetricUnit.Milliseconds,
+                           value=(time.perf_counter() - started) * 1000)
+
+    if len(events) > 0:
+        publish_events(events)
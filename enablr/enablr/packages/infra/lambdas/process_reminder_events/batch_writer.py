@@ -0,0 +1,154 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from boto3.dynamodb.types import TypeSerializer
+
+# The most requests batch_write_item will take in one call
+BATCH_SIZE = 25
+
+
+class UnprocessedItemsError(Exception):
+    '''Raised when DynamoDB still hasn't processed some items after every retry'''
+
+
+class BatchWriter:
+    '''Sends Put and Delete requests to a table in 25 item batches, a few batches at a time.
+    Anything DynamoDB hands back as UnprocessedItems is retried with exponential backoff rather than dropped.
+
+    Requests are plain python values (the same shape the dynamodb resource takes), they are converted to the typed format here
+    so the thread safe client can be shared between the workers.
+
+    An optional governor (see governor.py) paces the batches and is told how each one went.'''
+
+    def __init__(self, table_name, client, max_workers=4, max_attempts=8, base_delay=0.05, max_delay=5, governor=None):
+        self.table_name = table_name
+        self.client = client
+        self.governor = governor
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.written = 0
+        self.retried = 0
+        self.batches = 0
+        self.throttles = 0
+        self.consumed_wcu = 0.0
+        self.write_latency_ms = 0.0
+
+        self._serializer = TypeSerializer()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = []
+        self._in_flight = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def add(self, request):
+        '''Queue a single PutRequest or DeleteRequest, sending a batch as soon as there are enough'''
+        self._pending.append(self._serialize(request))
+        if len(self._pending) == BATCH_SIZE:
+            self._submit()
+
+    def write_all(self, requests):
+        '''Write every request and wait for them all to be stored'''
+        for request in requests:
+            self.add(request)
+        self.flush()
+
+    def flush(self):
+        '''Send whatever is queued and wait for every batch in flight to finish'''
+        if self._pending:
+            self._submit()
+
+        in_flight, self._in_flight = self._in_flight, set()
+        for future in in_flight:
+            future.result()
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'retried': self.retried,
+            'batches': self.batches,
+            'throttles': self.throttles,
+            'consumed_wcu': self.consumed_wcu,
+            'write_latency_ms': self.write_latency_ms
+        }
+
+    def _serialize(self, request):
+        if 'PutRequest' in request:
+            item = request['PutRequest']['Item']
+            return {'PutRequest': {'Item': {k: self._serializer.serialize(v) for k, v in item.items()}}}
+
+        key = request['DeleteRequest']['Key']
+        return {'DeleteRequest': {'Key': {k: self._serializer.serialize(v) for k, v in key.items()}}}
+
+    def _submit(self):
+        # Don't let batches queue up without limit, wait for one to finish when all the workers are busy
+        if len(self._in_flight) >= self.max_workers:
+            done, self._in_flight = wait(
+                self._in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        self._in_flight.add(self._executor.submit(
+            self._write_batch, self._pending))
+        self._pending = []
+
+    def _write_batch(self, requests):
+        attempt = 1
+        while True:
+            # Every item written here is under 1KB so each one costs a single write unit
+            if self.governor is not None:
+                self.governor.acquire(len(requests))
+
+            started = time.perf_counter()
+            response = self.client.batch_write_item(
+                RequestItems={self.table_name: requests},
+                ReturnConsumedCapacity='TOTAL'
+            )
+            latency_ms = (time.perf_counter() - started) * 1000
+
+            unprocessed = response.get(
+                'UnprocessedItems', {}).get(self.table_name, [])
+            # Throttled calls are retried inside botocore, it reports how many times it had to
+            throttles = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            consumed_wcu = sum(capacity.get('CapacityUnits', 0)
+                               for capacity in response.get('ConsumedCapacity', []))
+
+            if self.governor is not None:
+                self.governor.feedback(len(requests), consumed_wcu,
+                                       throttled=bool(unprocessed) or throttles > 0)
+
+            with self._lock:
+                self.written += len(requests) - len(unprocessed)
+                self.batches += 1
+                self.write_latency_ms += latency_ms
+                self.throttles += throttles
+                self.consumed_wcu += consumed_wcu
+
+            if not unprocessed:
+                return
+
+            if attempt >= self.max_attempts:
+                raise UnprocessedItemsError(
+                    f'{len(unprocessed)} items were still unprocessed after {attempt} attempts')
+
+            with self._lock:
+                self.retried += len(unprocessed)
+
+            # Full jitter so the workers don't all retry at the same moment
+            time.sleep(random.uniform(0, min(self.max_delay,
+                       self.base_delay * (2 ** attempt))))
+            attempt += 1
+            requests = unprocessed
@@ -0,0 +1,71 @@
+def net_update_type(first_update_type, last_update_type):
+    '''Work out the single operation a run of changes to one task adds up to.
+    Only the first change (did the task exist before?) and the last change (does it exist after?) matter'''
+    existed_before = first_update_type != 'CREATE'
+    exists_after = last_update_type != 'DELETE'
+
+    if existed_before and exists_after:
+        return 'UPDATE'
+    if existed_before:
+        return 'DELETE'
+    if exists_after:
+        return 'CREATE'
+    return None
+
+
+def expand_message(body):
+    '''Split a message into one body per task change.
+    Version 2 INDIVIDUAL messages carry every task change for an individual as {task_id: update_type},
+    messages without a version are the original one task per message format and are used as is'''
+    if body.get('version', 1) < 2:
+        return [body]
+
+    return [{
+        'target_type': body['target_type'],
+        'target_id': body['target_id'],
+        'task_id': task_id,
+        'update_type': update_type
+    } for task_id, update_type in body['changes'].items()]
+
+
+def coalesce_events(messages):
+    '''Fold every INDIVIDUAL message for the same (individual, task) into one net operation.
+    Takes (message_id, body) pairs in queue order. Returns the operations to run, each with the message ids it stands for,
+    and how many task changes no longer need any work. Other message types are passed through untouched'''
+    operations = []
+    folded = {}
+    individual_messages = 0
+
+    changes = [(message_id, change)
+               for message_id, body in messages for change in expand_message(body)]
+
+    for message_id, body in changes:
+        if body['target_type'] != 'INDIVIDUAL':
+            operations.append({**body, 'message_ids': [message_id]})
+            continue
+
+        individual_messages += 1
+        key = (body['target_id'], body['task_id'])
+
+        if key not in folded:
+            folded[key] = {
+                'target_type': 'INDIVIDUAL',
+                'target_id': body['target_id'],
+                'task_id': body['task_id'],
+                'first_update_type': body['update_type'],
+                'update_type': body['update_type'],
+                'message_ids': []
+            }
+            operations.append(folded[key])
+
+        folded[key]['update_type'] = body['update_type']
+        folded[key]['message_ids'].append(message_id)
+
+    for operation in folded.values():
+        operation['update_type'] = net_update_type(
+            operation.pop('first_update_type'), operation['update_type'])
+
+    individual_operations = [operation for operation in folded.values()
+                             if operation['update_type'] is not None]
+
+    return operations, individual_messages - len(individual_operations)
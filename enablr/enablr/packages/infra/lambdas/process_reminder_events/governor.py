@@ -0,0 +1,79 @@
+import time
+import threading
+
+
+class WriteGovernor:
+    '''A token bucket that paces writes to a table, refilled at a rate in write capacity units per second.
+    The rate backs off (halves) whenever a batch is throttled or comes back with UnprocessedItems, and creeps back up
+    a little after every clean batch, never going over the ceiling. That way background writes use whatever capacity
+    is spare without crowding out the writes the apps make.
+
+    One governor is shared by every writer in the lambda, so it is thread safe.'''
+
+    def __init__(self, ceiling, floor=None, decrease=0.5, increase=None, clock=time.monotonic, sleep=time.sleep):
+        self.ceiling = float(ceiling)
+        # By default never slow to less than a tenth of the ceiling, or a sweep could outlast the lambda timeout
+        self.floor = float(floor) if floor is not None else self.ceiling / 10
+        self.decrease = decrease
+        # Climbing from the floor back to the ceiling takes about 20 clean batches
+        self.increase = increase if increase is not None else self.ceiling / 20
+        self.clock = clock
+        self.sleep = sleep
+
+        # Start at half the ceiling, feedback moves it from there
+        self.rate = max(self.floor, self.ceiling / 2)
+        self.tokens = self.rate
+        self.updated = clock()
+
+        self.waited_ms = 0.0
+        self.backoffs = 0
+
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        '''Take units from the bucket, waiting until it has refilled enough.
+        The tokens are taken straight away (the bucket can go negative) so writers queue up behind each other fairly'''
+        with self._lock:
+            self._refill()
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            self.sleep(wait)
+            with self._lock:
+                self.waited_ms += wait * 1000
+
+    def feedback(self, requested, consumed, throttled):
+        '''Adjust after a batch. Anything consumed past what was asked for is taken off the bucket,
+        then the rate is cut if DynamoDB pushed back or nudged up if it didn't'''
+        with self._lock:
+            self._refill()
+            if consumed > requested:
+                self.tokens -= consumed - requested
+
+            if throttled:
+                self.rate = max(self.floor, self.rate * self.decrease)
+                self.backoffs += 1
+            else:
+                self.rate = min(self.ceiling, self.rate + self.increase)
+
+            # Never hold more than a second of writes, so a quiet spell can't be followed by a burst
+            self.tokens = min(self.tokens, self.rate)
+
+    def reset_stats(self):
+        '''The rate carries over between invocations, the counts don't'''
+        with self._lock:
+            self.waited_ms = 0.0
+            self.backoffs = 0
+
+    def stats(self):
+        return {
+            'governor_wait_ms': self.waited_ms,
+            'governor_backoffs': self.backoffs,
+            'governor_rate': self.rate
+        }
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
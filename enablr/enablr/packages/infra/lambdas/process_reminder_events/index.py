@@ -1,52 +1,163 @@
 import json
 import os
 import math
+import time
 import datetime
-from pytz import timezone, utc
+from collections import Counter
+from contextlib import contextmanager
+from pytz import utc
 import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+import schedule
+import batch_writer
+import coalesce
+import governor
+import reminder_item
 
 dynamodb_resource = boto3.resource('dynamodb')
 
 # The client has more functionality but it's more complicated than the resource
 dynamodb_client = boto3.client('dynamodb')
+sqs_client = boto3.client('sqs')
 current_time = datetime.datetime.now(utc)
 
+# Metrics are written to the logs in CloudWatch embedded metric format at the end of each invocation
+metrics = Metrics(namespace="Enablr", service="process_reminder_events")
+# Running totals for the current invocation, turned into metrics once it finishes
+invocation_stats = Counter()
+
 individual_table = dynamodb_resource.Table(os.environ['INDIVIDUAL_TABLE_NAME'])
 reminder_table = dynamodb_resource.Table(os.environ['REMINDER_TABLE_NAME'])
-
-
-def get_individual_details(individual_id):
-    batch_keys = {
-        individual_table.name: {
-            'Keys': [{'individual_id': individual_id}]
+# A sparse index that only holds reminders that haven't been completed yet
+REMINDER_TABLE_PENDING_INDEX_NAME = os.environ['REMINDER_TABLE_PENDING_INDEX_NAME']
+# Reminders written before the pending index existed have no pending_reminder_id, so they aren't in it.
+# scripts/backfill-pending-index.py puts them in when a deployment is upgraded, turn this on to have cleanup also look for them
+# on the table itself if that can't be run straight away. It costs a second read of the tasks future reminders every time
+UNINDEXED_CLEANUP = os.environ.get('REMINDER_UNINDEXED_CLEANUP', 'false') == 'true'
+# Records how far ahead reminders have been generated for each individuals task
+watermark_table = dynamodb_resource.Table(
+    os.environ['REMINDER_WATERMARK_TABLE_NAME'])
+
+# How many days of reminders (today included) are generated ahead of time
+LOOKAHEAD_DAYS = int(os.environ.get('REMINDER_LOOKAHEAD_DAYS', '1'))
+# 'item' stores each reminder as its own item. 'day' packs each tasks reminders for a local day into one item with a slot per reminder,
+# one write a day instead of one per reminder. The readers handle both so the mode can be switched over with reminders of both kinds stored
+DAY_BUCKETS = os.environ.get('REMINDER_STORAGE_MODE', 'item') == 'day'
+# Day items aren't in the pending index, so after switching from 'day' back to 'item' their pending slots are only found by
+# reading the table. Turn this on for the switch back, it can be turned off again once the last day items are in the past
+DAY_ITEM_CLEANUP = os.environ.get('REMINDER_DAY_ITEM_CLEANUP', 'false') == 'true'
+
+# The ALL sweep fans out onto this queue, one message per scan segment. It is read one message at a time so a segment
+# always has an invocation (and its time limit) to itself
+SWEEP_QUEUE_URL = os.environ['SWEEP_QUEUE_URL']
+# How many parallel segments the individual table scan is split into for the ALL sweep
+SWEEP_TOTAL_SEGMENTS = int(os.environ.get('SWEEP_TOTAL_SEGMENTS', '8'))
+# When a segment has less than this much time left it checkpoints and hands the rest on in a continuation message
+SWEEP_TIME_BUFFER_MS = int(os.environ.get('SWEEP_TIME_BUFFER_MS', '120000'))
+# Individuals read (and scheduled together) per scan page. The time left is checked after every individual, not just between pages
+SWEEP_PAGE_SIZE = int(os.environ.get('SWEEP_PAGE_SIZE', '100'))
+
+# The most write units a second this lambda (each concurrent invocation) will use. Writes are paced under it and slow down
+# when DynamoDB throttles, leaving room for the apps writes
+WRITE_WCU_CEILING = float(os.environ.get('REMINDER_WRITE_WCU_CEILING', '100'))
+# Kept at module level so what was learnt about the tables capacity carries over to the next invocation in a warm lambda
+write_governor = governor.WriteGovernor(WRITE_WCU_CEILING)
+
+
+def get_individuals_details(individual_ids):
+    '''Load the tasks and timezone for many individuals at once, 100 keys per batch_get_item (the most it allows).
+    Returns a dict keyed by individual_id, anyone that no longer exists is left out'''
+    individual_ids = list(individual_ids)
+    individuals = {}
+
+    for i in range(0, len(individual_ids), 100):
+        request_items = {
+            individual_table.name: {
+                'Keys': [{'individual_id': individual_id} for individual_id in individual_ids[i:i + 100]],
+                'ProjectionExpression': '#i, #t, #d.#z',
+                'ExpressionAttributeNames': {
+                    '#i': 'individual_id',
+                    '#t': 'tasks',
+                    '#d': 'details',
+                    '#z': 'tz'
+                }
+            }
         }
-    }
-
-    response = dynamodb_resource.batch_get_item(
-        RequestItems=batch_keys
-    )
 
-    individual = response['Responses'][individual_table.name][0]
-    # get individual from dynamodb
-    # extract tasks
-    # return tasks in json format
-    return {'tasks': individual['tasks'], 'timezone': individual['details']['tz']}
-
-
-def create_reminder(timestamp, task, individual_id, time):
-    task_id = task['task_id']
+        while request_items:
+            response = dynamodb_resource.batch_get_item(
+                RequestItems=request_items
+            )
+
+            for individual in response['Responses'][individual_table.name]:
+                individuals[individual['individual_id']] = {
+                    'tasks': individual['tasks'],
+                    'timezone': individual['details']['tz']
+                }
+
+            request_items = response.get('UnprocessedKeys')
+
+    return individuals
+
+
+@contextmanager
+def timed(stage):
+    '''Add the time spent in a stage of the pipeline on to this invocations totals'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation_stats[stage] += (time.perf_counter() - started) * 1000
+
+
+def record_writer(writer, written_stat):
+    '''Fold a batch writers counts into this invocations totals'''
+    stats = writer.stats()
+    invocation_stats[written_stat] += stats.pop('written')
+    invocation_stats.update(stats)
+
+
+def publish_metrics():
+    '''Turn this invocations totals into metrics'''
+    for name, stat, unit in [
+        ('ScanTime', 'scan_ms', MetricUnit.Milliseconds),
+        ('ScheduleComputeTime', 'schedule_ms', MetricUnit.Milliseconds),
+        ('DynamoWriteLatency', 'write_latency_ms', MetricUnit.Milliseconds),
+        ('DynamoWriteBatches', 'batches', MetricUnit.Count),
+        ('ConsumedWCU', 'consumed_wcu', MetricUnit.Count),
+        ('Throttles', 'throttles', MetricUnit.Count),
+        ('UnprocessedRetries', 'retried', MetricUnit.Count),
+        ('RemindersWritten', 'reminders_written', MetricUnit.Count),
+        ('WatermarksWritten', 'watermarks_written', MetricUnit.Count),
+        ('IndividualsSwept', 'individuals', MetricUnit.Count),
+        ('MessagesCoalesced', 'coalesced', MetricUnit.Count),
+    ]:
+        metrics.add_metric(name=name, unit=unit, value=invocation_stats[stat])
+
+    governor_stats = write_governor.stats()
+    metrics.add_metric(name='GovernorWaitTime', unit=MetricUnit.Milliseconds,
+                       value=governor_stats['governor_wait_ms'])
+    metrics.add_metric(name='GovernorBackoffs', unit=MetricUnit.Count,
+                       value=governor_stats['governor_backoffs'])
+    metrics.add_metric(name='GovernorWriteRate', unit=MetricUnit.CountPerSecond,
+                       value=governor_stats['governor_rate'])
+
+    if invocation_stats['batches']:
+        metrics.add_metric(name='DynamoWriteLatencyPerBatch', unit=MetricUnit.Milliseconds,
+                           value=invocation_stats['write_latency_ms'] / invocation_stats['batches'])
+
+    if invocation_stats['individuals']:
+        metrics.add_metric(name='ItemsPerIndividual', unit=MetricUnit.Count,
+                           value=invocation_stats['reminders_written'] / invocation_stats['individuals'])
+
+
+def create_reminder(timestamp, task, individual_id, task_version):
     return {
         "PutRequest": {
-            "Item": {
-                "reminder_id": f'{individual_id}-{task_id}',
-                'task_id': task_id,
-                'individual_id': individual_id,
-                "due": timestamp,
-                "readable_timestamp": time,
-                "details": task,
-                "completed": False,
-                "note": ""
-            }
+            "Item": reminder_item.create_reminder_item(individual_id, task['task_id'], timestamp, task_version)
         }
     }
 
@@ -64,146 +175,689 @@ def delete_reminder(existing_reminder):
     }
 
 
-def publish_updates(updates):
-    batch_keys = {
-        reminder_table.name: updates
-    }
+def create_records(target_id, task, tz):
+    return create_all_records([(target_id, task, tz)])
 
-    response = dynamodb_resource.batch_write_item(
-        RequestItems=batch_keys
-    )
 
-
-def create_records(target_id, task, tz):
-    start_time = task['details']['startTime']
-    end_time = task['details']['endTime']
+def create_all_records(targets):
+    '''Create the reminders for many (individual_id, task, tz) targets at once, for every day in the lookahead.
+    The schedule compiler works out the timestamps for every target together rather than one task at a time'''
 
     # Make sure to localize the time to whatever the individual operates in. This will be important since Australia has several timezones
     # And the timezone the lambda is in may be different to the childs timezone
+    with timed('schedule_ms'):
+        index, due = schedule.compile_schedules(
+            [(task['details'], tz) for _, task, tz in targets], current_time, LOOKAHEAD_DAYS)
 
-    timezone_time = current_time.astimezone(timezone(tz))
-    earliest_time = timezone_time.replace(
-        day=timezone_time.day,
-        hour=start_time["h"], minute=start_time["m"], second=0, microsecond=0)
-
-    latest_time = timezone_time.replace(day=timezone_time.day,
-                                        hour=end_time["h"], minute=end_time["m"], second=0, microsecond=0)
+        versions = [reminder_item.get_task_version(task, tz) for _, task, tz in targets]
 
-    frequency = task['details']['frequency'] - 1
+        if DAY_BUCKETS:
+            return create_day_records(targets, versions, index.tolist(), due.tolist())
 
-    # Math stuff below here is summed up as:
-    # If more than one reminder is needed, then work out the distance between reminders and create a reminder for each block
-    # Until the final time has been reached
+        updates = []
+        for i, reminder in zip(index.tolist(), due.tolist()):
+            target_id, task, _ = targets[i]
+            updates.append(create_reminder(
+                reminder, task, target_id, versions[i]))
 
-    reminders = [math.floor(earliest_time.timestamp())]
+    return updates
 
-    if frequency > 0:
-        distance = (latest_time.timestamp() -
-                    earliest_time.timestamp())/float(frequency)
 
-        travelled = earliest_time.timestamp() + distance
+def create_day_records(targets, versions, index, due):
+    '''Pack the compiled reminders into one item per target per local day.
+    The compiled reminders are already grouped by target and in time order, so each day's slots come out in order too'''
+    now_timestamp = current_time.timestamp()
 
-        while travelled <= latest_time.timestamp():
-            reminders.append(math.floor(travelled))
-            travelled = travelled + distance
+    days = {}
+    for i, reminder in zip(index, due):
+        target_id, task, tz = targets[i]
+        # The day a reminder falls in is the latest day that starts before it
+        day_start = max(start for start in (schedule.get_day_origin(tz, now_timestamp, days_ahead)[0]
+                                            for days_ahead in range(LOOKAHEAD_DAYS)) if start <= reminder)
+        days.setdefault((i, day_start), []).append(reminder)
 
     updates = []
-    for reminder in reminders:
-        # dont include reminders that have already occurred
-        if reminder > timezone_time.timestamp():
-            time = timezone(tz).localize(
-                datetime.datetime.fromtimestamp(reminder))
-
-            updates.append(create_reminder(
-                reminder, task, target_id, str(time)))
+    for (i, day_start), dues in days.items():
+        target_id, task, _ = targets[i]
+        updates.append({
+            "PutRequest": {
+                "Item": reminder_item.create_day_item(
+                    target_id, task['task_id'], day_start, [reminder_item.create_slot(d) for d in dues], versions[i])
+            }
+        })
 
     return updates
 
 
-def process_updates(updates):
-    count = 0
-    next_updates = []
-    for update in updates:
-        count += 1
-        next_updates.append(update)
-        if count == 25:
-            publish_updates(next_updates)
-            count = 0
-            next_updates = []
+def get_watermarks(reminder_ids):
+    '''Load the generated through watermarks for many reminder ids, 100 keys per batch_get_item'''
+    reminder_ids = list(reminder_ids)
+    watermarks = {}
 
-    if count > 0:
-        publish_updates(next_updates)
+    for i in range(0, len(reminder_ids), 100):
+        request_items = {
+            watermark_table.name: {
+                'Keys': [{'reminder_id': reminder_id} for reminder_id in reminder_ids[i:i + 100]]
+            }
+        }
 
+        while request_items:
+            response = dynamodb_resource.batch_get_item(
+                RequestItems=request_items
+            )
 
-def delete_remaining_tasks(individual_id, task_id):
-    response = dynamodb_client.query(
-        TableName=reminder_table.name,
-        KeyConditionExpression='reminder_id = :reminder_id AND due > :due',
-        FilterExpression='completed <> :completed',
-        ExpressionAttributeValues={
+            for watermark in response['Responses'][watermark_table.name]:
+                watermarks[watermark['reminder_id']] = watermark
+
+            request_items = response.get('UnprocessedKeys')
+
+    return watermarks
+
+
+def create_watermark(target_id, task, tz):
+    '''Record that reminders for this version of the task have been generated through the last day of the lookahead'''
+    return {
+        "PutRequest": {
+            "Item": {
+                "reminder_id": f'{target_id}-{task["task_id"]}',
+                "generated_through": schedule.get_local_date(tz, current_time.timestamp(), LOOKAHEAD_DAYS - 1),
+                "task_version": reminder_item.get_task_version(task, tz)
+            }
+        }
+    }
+
+
+def delete_watermark(target_id, task_id):
+    return {
+        "DeleteRequest": {
+            "Key": {
+                "reminder_id": f'{target_id}-{task_id}'
+            }
+        }
+    }
+
+
+def watermark_covers(watermark, task, tz):
+    '''Check if the reminders for a task have already been generated through the end of the lookahead'''
+    if watermark is None or watermark['task_version'] != reminder_item.get_task_version(task, tz):
+        return False
+
+    return watermark['generated_through'] >= schedule.get_local_date(tz, current_time.timestamp(), LOOKAHEAD_DAYS - 1)
+
+
+def process_updates(deletes, updates, watermarks):
+    '''Write the deletes and then the updates. The deletes have to finish first as an update can put the same key back.
+    The watermarks go last so they are only moved on once the reminders they cover are stored'''
+    with batch_writer.BatchWriter(reminder_table.name, dynamodb_client, governor=write_governor) as writer:
+        writer.write_all(deletes)
+        writer.write_all(updates)
+
+    with batch_writer.BatchWriter(watermark_table.name, dynamodb_client, governor=write_governor) as watermark_writer:
+        watermark_writer.write_all(watermarks)
+
+    record_writer(writer, 'reminders_written')
+    record_writer(watermark_writer, 'watermarks_written')
+
+    return writer.stats()
+
+
+def get_pending_reminders(individual_id, task_id):
+    '''Get the keys of every reminder still to come that hasn't been completed, using the sparse pending index so completed reminders are never read'''
+    query_kwargs = {
+        'TableName': reminder_table.name,
+        'IndexName': REMINDER_TABLE_PENDING_INDEX_NAME,
+        'KeyConditionExpression': 'pending_reminder_id = :reminder_id AND due > :due',
+        'ExpressionAttributeValues': {
+            ':reminder_id': {'S': f'{individual_id}-{task_id}'},
+            ':due': {'N':  str(math.floor(current_time.timestamp()))}
+        }
+    }
+
+    reminders = []
+    while True:
+        response = dynamodb_client.query(**query_kwargs)
+        reminders.extend(response['Items'])
+
+        if 'LastEvaluatedKey' not in response:
+            return reminders
+
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_unindexed_reminders(individual_id, task_id):
+    '''Get the keys of every reminder still to come that hasn't been completed but is missing from the pending index.
+    Reads the tasks future reminders off the table and filters them, so only used while UNINDEXED_CLEANUP is on'''
+    query_kwargs = {
+        'TableName': reminder_table.name,
+        'KeyConditionExpression': 'reminder_id = :reminder_id AND due > :due',
+        'FilterExpression': 'attribute_not_exists(pending_reminder_id) AND completed = :completed',
+        'ProjectionExpression': 'reminder_id, due',
+        'ExpressionAttributeValues': {
             ':reminder_id': {'S': f'{individual_id}-{task_id}'},
             ':due': {'N':  str(math.floor(current_time.timestamp()))},
-            ':completed': {'BOOL': True}
+            ':completed': {'BOOL': False}
         }
-    )
+    }
+
+    reminders = []
+    while True:
+        response = dynamodb_client.query(**query_kwargs)
+        reminders.extend(response['Items'])
+
+        if 'LastEvaluatedKey' not in response:
+            return reminders
+
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_day_items(individual_id, task_id):
+    '''Get an individuals tasks day items from today on. They aren't in the pending index, so this is how
+    their pending slots are found once reminders are stored one per item again. Only used while DAY_ITEM_CLEANUP is on'''
+    query_kwargs = {
+        'KeyConditionExpression': Key('reminder_id').eq(f'{individual_id}-{task_id}') & Key('due').gt(day_items_since()),
+        'FilterExpression': Attr('slots').exists()
+    }
 
-    to_delete = response['Items']
+    days = []
+    while True:
+        response = reminder_table.query(**query_kwargs)
+        days.extend(response['Items'])
 
+        if 'LastEvaluatedKey' not in response:
+            return days
+
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_remaining_tasks(individual_id, task_id):
     updates = []
-    for td in to_delete:
+    for td in get_pending_reminders(individual_id, task_id):
         updates.append(delete_reminder(td))
+
+    if UNINDEXED_CLEANUP:
+        for td in get_unindexed_reminders(individual_id, task_id):
+            updates.append(delete_reminder(td))
     return updates
 
 
-def get_all_individuals():
-    response = individual_table.scan()
+def day_items_since():
+    '''Day items are keyed by when their day starts. A local day is at most 25 hours long,
+    so going back that far picks up today's whichever timezone it's in'''
+    return math.floor(current_time.timestamp()) - 25 * 3600
 
-    return response['Items']
 
+def get_future_reminders(individual_id, task_id):
+    '''Get every reminder still to come for an individuals task, completed or not.
+    When day items can be stored it also goes back far enough to pick up today's day item'''
+    since = math.floor(current_time.timestamp())
+    if DAY_BUCKETS or DAY_ITEM_CLEANUP:
+        since = day_items_since()
 
-def lambda_handler(event, context):
-    print(event)
+    query_kwargs = {
+        'KeyConditionExpression': Key('reminder_id').eq(f'{individual_id}-{task_id}') & Key('due').gt(since),
+        # Only what reconciling looks at, older reminders still carry a copy of the task details that would be read for nothing
+        'ProjectionExpression': '#r, #d, #c, #v, #p, #s',
+        'ExpressionAttributeNames': {'#r': 'reminder_id', '#d': 'due', '#c': 'completed', '#v': 'task_version',
+                                     '#p': 'pending_reminder_id', '#s': 'slots'}
+    }
+
+    reminders = []
+    while True:
+        response = reminder_table.query(**query_kwargs)
+        reminders.extend(response['Items'])
+
+        if 'LastEvaluatedKey' not in response:
+            return reminders
+
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def reconcile_reminders(existing_reminders, desired_updates):
+    '''Diff the reminders that should exist against the ones already stored, only returning the writes needed to get from one to the other.
+    Completed reminders are left alone, and a pending reminder that already matches is not written again'''
+    if DAY_BUCKETS:
+        return reconcile_days(existing_reminders, desired_updates)
+
+    now = math.floor(current_time.timestamp())
+
+    # Day items left from when day items were on are trimmed down to what has already happened.
+    # Reminders from the lookback that are past are left as they are
+    existing = {}
+    days = []
+    for reminder in existing_reminders:
+        if 'slots' in reminder:
+            days.append(reminder)
+        elif int(reminder['due']) > now:
+            existing[int(reminder['due'])] = reminder
 
-    updates = []
     deletes = []
-    for record in event['Records']:
-        body = json.loads(record['body'])
-        target_type = body['target_type']
+    puts = []
+    desired_dues = set()
+    for update in desired_updates:
+        item = update['PutRequest']['Item']
+        desired_dues.add(item['due'])
+        reminder = existing.get(item['due'])
+
+        if reminder is None:
+            puts.append(update)
+        elif not reminder['completed'] and (reminder.get('task_version') != item['task_version'] or 'pending_reminder_id' not in reminder):
+            # Pending reminders written before the pending index or the compact schema existed are rewritten,
+            # which puts them in the index and drops the copied task details
+            puts.append(update)
+
+    for due, reminder in existing.items():
+        if due not in desired_dues and not reminder['completed']:
+            deletes.append(delete_request(reminder))
+
+    day_deletes, puts = reconcile_day_items(days, puts)
+    return deletes + day_deletes, puts
+
+
+def reconcile_days(existing_reminders, desired_updates):
+    '''reconcile_reminders for day items. Completed and past slots are carried over into the regenerated day, a day left with no slots
+    is deleted, and pending reminders stored one per item (from before day items were turned on) are replaced by the days'''
+    now = math.floor(current_time.timestamp())
+
+    existing_days = {}
+    deletes = []
+    for reminder in existing_reminders:
+        if 'slots' in reminder:
+            existing_days[int(reminder['due'])] = reminder
+        elif int(reminder['due']) > now and not reminder['completed']:
+            deletes.append(reminder)
+
+    puts = []
+    for update in desired_updates:
+        item = update['PutRequest']['Item']
+        day = existing_days.pop(item['due'], None)
+        if day is None:
+            puts.append(update)
+            continue
+
+        # Writing a day back over a slot the device has just completed would lose it. The window is only as long as this invocation,
+        # and a task edit is all that makes a day get rewritten, so the device's completion is simply sent again if it is lost
+        item['slots'] = reminder_item.merge_slots(
+            day['slots'], [int(slot['due']) for slot in item['slots']], now)
+        if item['slots'] != day['slots'] or item['task_version'] != day.get('task_version'):
+            puts.append(update)
+
+    # Days that aren't wanted any more keep only what has already happened
+    day_deletes, puts = reconcile_day_items(existing_days.values(), puts)
+
+    # A reminder stored on its own that was due right as a day starts has the day's key, so the day being put replaces it.
+    # Deleting it as well would put two writes for one key in the same stream
+    put_dues = {int(update['PutRequest']['Item']['due']) for update in puts}
+    deletes = [reminder for reminder in deletes if int(reminder['due']) not in put_dues]
+
+    return [delete_request(reminder) for reminder in deletes] + day_deletes, puts
+
+
+def reconcile_day_items(days, puts):
+    '''Bring day items that aren't being regenerated in line with the reminders being put one per item.
+    Each day keeps only its completed and past slots, and a day left with none is deleted. A reminder due right as a day starts
+    has the same key as the day, so if the day still has slots worth keeping the reminder goes into it as a slot instead of replacing it.
+    Returns the deletes, and the puts with the days folded in'''
+    now = math.floor(current_time.timestamp())
+    put_dues = {update['PutRequest']['Item']['due'] for update in puts}
 
-        if (target_type == 'INDIVIDUAL'):
+    deletes = []
+    day_puts = []
+    for day in days:
+        due = int(day['due'])
+        slots = reminder_item.merge_slots(day['slots'], [], now)
 
-            target_id = body['target_id']
-            task_id = body['task_id']
-            update_type = body['update_type']
+        if due in put_dues:
+            if not slots:
+                continue
+            puts = [update for update in puts if update['PutRequest']['Item']['due'] != due]
+            slots = reminder_item.merge_slots(day['slots'], [due], now)
 
-            # First add in updates to cleanup existing tasks.
-            if update_type in ['DELETE', 'UPDATE']:
-                deletes.extend(delete_remaining_tasks(target_id, task_id))
+        if not slots:
+            deletes.append(delete_request(day))
+        elif slots != day['slots']:
+            day_puts.append({"PutRequest": {"Item": {**day, 'slots': slots}}})
 
-            # Add in updates to create new tasks.
-            if update_type in ['CREATE', 'UPDATE']:
-                details = get_individual_details(target_id)
+    return deletes, puts + day_puts
 
-                task = next(
-                    (task for task in details['tasks'] if task['task_id'] == task_id), None)
 
-                if task is not None:
-                    updates.extend(create_records(
-                        target_id, task, details['timezone']))
+def delete_request(reminder):
+    return {
+        "DeleteRequest": {
+            "Key": {
+                "reminder_id": reminder['reminder_id'],
+                "due": int(reminder['due']),
+            }
+        }
+    }
+
+
+def scan_page(scan_kwargs, cursor):
+    '''Read one page of a segment of the individual table starting from cursor (None for the start of the segment).
+    Returns the individuals and the cursor to carry on from, None once it's the last page'''
+    if cursor is not None:
+        scan_kwargs = {**scan_kwargs, 'ExclusiveStartKey': cursor}
+
+    with timed('scan_ms'):
+        response = individual_table.scan(**scan_kwargs)
+    invocation_stats['individuals'] += len(response['Items'])
+
+    return response['Items'], response.get('LastEvaluatedKey')
+
+
+def sync_individuals(individuals):
+    '''Yield each individual in a page in turn, with the writes needed to bring their tasks up to date and the tasks new watermarks'''
+    targets = []
+    for individual in individuals:
+        for task in individual['tasks']:
+            targets.append(
+                (individual['individual_id'], task, individual['details']['tz']))
+
+    # Skip every task that already has its reminders generated through the end of the lookahead
+    existing_watermarks = get_watermarks(
+        f'{target_id}-{task["task_id"]}' for target_id, task, _ in targets)
+    targets = [(target_id, task, tz) for target_id, task, tz in targets
+               if not watermark_covers(existing_watermarks.get(f'{target_id}-{task["task_id"]}'), task, tz)]
+
+    desired = {}
+    for update in create_all_records(targets):
+        item = update['PutRequest']['Item']
+        desired.setdefault(item['reminder_id'], []).append(update)
+
+    individual_targets = {}
+    for target in targets:
+        individual_targets.setdefault(target[0], []).append(target)
+
+    # Only write what has actually changed since the last sweep
+    for individual in individuals:
+        writes = []
+        watermarks = []
+        for target_id, task, tz in individual_targets.get(individual['individual_id'], []):
+            existing_reminders = get_future_reminders(
+                target_id, task['task_id'])
+            reminder_deletes, reminder_puts = reconcile_reminders(
+                existing_reminders, desired.pop(f'{target_id}-{task["task_id"]}', []))
+
+            # The deletes and puts never share a key so they can go out together
+            writes.extend(reminder_deletes + reminder_puts)
+            watermarks.append(create_watermark(target_id, task, tz))
+
+        yield individual['individual_id'], writes, watermarks
+
+
+def process_segment(body, context):
+    '''Sweep one segment of the individual table as a stream: each page is scheduled and reconciled as it arrives and the writes
+    are handed to the batch writer straight away, so they go out while the rest of the segment is still being read.
+    If the lambda is running out of time the scan cursor and progress so far are put back on the queue as a continuation
+    message, and the next invocation carries on from there'''
+    scan_kwargs = {
+        'Segment': body['segment'],
+        'TotalSegments': body['total_segments'],
+        'Limit': SWEEP_PAGE_SIZE
+    }
+    cursor = body.get('exclusive_start_key')
+    finished = False
+
+    progress = body.get('progress', {'individuals': 0, 'written': 0, 'retried': 0})
+
+    with batch_writer.BatchWriter(reminder_table.name, dynamodb_client, governor=write_governor) as writer, \
+            batch_writer.BatchWriter(watermark_table.name, dynamodb_client, governor=write_governor) as watermark_writer:
+
+        # Checked before the first page and after every individual. Paced writes can make one page take longer than the
+        # whole buffer, so a page is left part way through when the time runs out
+        stopped = context.get_remaining_time_in_millis() < SWEEP_TIME_BUFFER_MS
+        while not stopped and not finished:
+            individuals, next_cursor = scan_page(scan_kwargs, cursor)
+
+            watermarks = []
+            for individual_id, writes, individual_watermarks in sync_individuals(individuals):
+                for write in writes:
+                    writer.add(write)
+                watermarks.extend(individual_watermarks)
+                progress['individuals'] += 1
+
+                # An individuals key works as the cursor to carry on from just after them
+                cursor = {'individual_id': individual_id}
+                if context.get_remaining_time_in_millis() < SWEEP_TIME_BUFFER_MS:
+                    stopped = True
+                    break
+            else:
+                cursor = next_cursor
+                finished = cursor is None
+
+            # The watermarks only move on once the reminders they cover are stored
+            writer.flush()
+            for watermark in watermarks:
+                watermark_writer.add(watermark)
+
+        if not finished:
+            watermark_writer.flush()
+            print(f'segment {body["segment"]} continuing {totals(progress, writer)}')
+            send_continuation(body, cursor, totals(progress, writer))
+
+    record_writer(writer, 'reminders_written')
+    record_writer(watermark_writer, 'watermarks_written')
+
+    if finished:
+        print(f'segment {body["segment"]} complete {totals(progress, writer)}')
+
+
+def totals(progress, writer):
+    '''Add what the writer has done in this invocation on to the progress carried over from earlier ones'''
+    return {
+        'individuals': progress['individuals'],
+        'written': progress['written'] + writer.written,
+        'retried': progress['retried'] + writer.retried
+    }
+
+
+def send_continuation(body, exclusive_start_key, progress):
+    '''Queue the rest of a segment. It goes in the same message group so it only starts once this message has finished'''
+    continuation = body.get('continuation', 0) + 1
+    message = {
+        "target_type": 'SEGMENT',
+        "segment": body['segment'],
+        "total_segments": body['total_segments'],
+        "sweep_id": body['sweep_id'],
+        "continuation": continuation,
+        "progress": progress
+    }
+    # No cursor means the segment hadn't been started, so the continuation starts it from the beginning
+    if exclusive_start_key is not None:
+        message['exclusive_start_key'] = exclusive_start_key
+
+    sqs_client.send_message(
+        QueueUrl=SWEEP_QUEUE_URL,
+        MessageBody=json.dumps(message),
+        MessageDeduplicationId=f'{body["sweep_id"]}-{body["segment"]}-{continuation}',
+        MessageGroupId=f'scheduled-{body["segment"]}'
+    )
+
+
+def create_segment_entry(sweep_id, segment, total_segments):
+    return {
+        'Id': str(segment),
+        'MessageBody': json.dumps({
+            "target_type": 'SEGMENT',
+            "segment": segment,
+            "total_segments": total_segments,
+            "sweep_id": sweep_id
+        }),
+        'MessageDeduplicationId': f'{sweep_id}-{segment}',
+        # Each segment gets its own message group so the segments are processed concurrently
+        'MessageGroupId': f'scheduled-{segment}'
+    }
 
-        if (target_type == 'ALL'):
-            individuals = get_all_individuals()
-            for individual in individuals:
-                for task in individual['tasks']:
 
-                    deletes.extend(delete_remaining_tasks(
-                        individual['individual_id'], task['task_id']))
-                    updates.extend(create_records(
-                        individual['individual_id'], task, individual['details']['tz']))
+def fan_out_segments(sweep_id, total_segments):
+    '''Split the ALL sweep into one queue message per scan segment so each segment is handled by its own invocation.
+    The sweep id is the ALL messages id, which stays the same when that message is retried'''
+    entries = [create_segment_entry(sweep_id, segment, total_segments)
+               for segment in range(total_segments)]
+
+    # send_message_batch only accepts 10 entries at a time
+    for i in range(0, len(entries), 10):
+        response = sqs_client.send_message_batch(
+            QueueUrl=SWEEP_QUEUE_URL,
+            Entries=entries[i:i + 10]
+        )
+
+        # A partial failure doesn't raise, so fail the ALL message here and let it be retried. The deduplication ids are
+        # fixed for the sweep so segments that did get sent aren't queued twice inside SQS's 5 minute window, and past it
+        # the watermarks mean sweeping a segment again only rewrites what isn't already covered
+        failed = response.get('Failed', [])
+        if failed:
+            raise Exception(f'Failed to queue sweep segments {[entry["Id"] for entry in failed]}')
+
+
+def process_individual(body, individuals, individual_tasks):
+    '''Work out the writes for one task change. Returns the reminder deletes, reminder puts and watermark writes'''
+    deletes = []
+    updates = []
+    watermarks = []
+
+    target_id = body['target_id']
+    task_id = body['task_id']
+    update_type = body['update_type']
+
+    # A day item can hold completed reminders next to pending ones, so rather than deleting and recreating,
+    # the days are reconciled against what the task should have now (nothing, if it's been deleted)
+    if DAY_BUCKETS:
+        desired = []
+        task = None
+        if update_type in ['CREATE', 'UPDATE'] and target_id in individuals:
+            details = individuals[target_id]
+            task = individual_tasks[target_id].get(task_id)
+            if task is not None:
+                desired = create_records(target_id, task, details['timezone'])
+
+        if update_type is not None:
+            deletes, updates = reconcile_reminders(
+                get_future_reminders(target_id, task_id), desired)
+
+        if task is not None:
+            watermarks.append(create_watermark(
+                target_id, task, details['timezone']))
+        elif update_type == 'DELETE':
+            watermarks.append(delete_watermark(target_id, task_id))
+
+        return deletes, updates, watermarks
+
+    # First add in updates to cleanup existing tasks.
+    days = []
+    if update_type in ['DELETE', 'UPDATE']:
+        deletes.extend(delete_remaining_tasks(target_id, task_id))
+        if DAY_ITEM_CLEANUP:
+            days = get_day_items(target_id, task_id)
+
+    if update_type == 'DELETE':
+        watermarks.append(delete_watermark(target_id, task_id))
+
+    # Add in updates to create new tasks.
+    if update_type in ['CREATE', 'UPDATE'] and target_id in individuals:
+        details = individuals[target_id]
+        task = individual_tasks[target_id].get(task_id)
+
+        if task is not None:
+            updates.extend(create_records(
+                target_id, task, details['timezone']))
+            watermarks.append(create_watermark(
+                target_id, task, details['timezone']))
+
+    # Days stored while day items were on lose their pending slots, these reminders replace them
+    day_deletes, updates = reconcile_day_items(days, updates)
+    deletes.extend(day_deletes)
+
+    return deletes, updates, watermarks
+
+
+@metrics.log_metrics
+def lambda_handler(event, context):
+    print(event)
+
+    # A warm lambda is reused across invocations, so the time needs to be taken fresh each time
+    global current_time
+    current_time = datetime.datetime.now(utc)
+    invocation_stats.clear()
+    write_governor.reset_stats()
+
+    updates = []
+    deletes = []
+    watermarks = []
+
+    # Each message is reported back on its own, so a retry only repeats the messages that actually failed.
+    # Messages in a FIFO group have to be handled in order, so once one fails the rest of its group is failed with it
+    message_groups = {record['messageId']: record.get('attributes', {}).get('MessageGroupId')
+                      for record in event['Records']}
+    failed_groups = set()
+    failed_ids = []
+
+    # Several changes to the same task in one batch only need the net result applied
+    operations, eliminated = coalesce.coalesce_events(
+        [(record['messageId'], json.loads(record['body'])) for record in event['Records']])
+    print(f'coalesced {eliminated} task changes from {len(event["Records"])} messages')
+    invocation_stats['coalesced'] += eliminated
+
+    # Load every individual the batch needs to create reminders for up front, once each.
+    # A message can carry many task changes for one individual so their tasks are looked up by id
+    individuals = get_individuals_details({
+        body['target_id'] for body in operations
+        if body['target_type'] == 'INDIVIDUAL' and body['update_type'] in ['CREATE', 'UPDATE']
+    })
+    individual_tasks = {individual_id: {task['task_id']: task for task in details['tasks']}
+                        for individual_id, details in individuals.items()}
+
+    # The individual writes are sent together at the end, these are the messages depending on them
+    written_ids = []
+
+    for body in operations:
+        target_type = body['target_type']
+        groups = {message_groups[message_id] for message_id in body['message_ids']}
+
+        if groups & failed_groups:
+            failed_ids.extend(body['message_ids'])
+            continue
+
+        # A segment that can't get through a page before the time runs out isn't started, it's handed back to be retried.
+        # Its group is failed too so any continuation of it behind it waits
+        if target_type == 'SEGMENT' and context.get_remaining_time_in_millis() < SWEEP_TIME_BUFFER_MS:
+            print(f'deferring segment {body["segment"]}')
+            failed_groups.update(groups)
+            failed_ids.extend(body['message_ids'])
+            continue
+
+        try:
+            if (target_type == 'INDIVIDUAL'):
+                individual_deletes, individual_updates, individual_watermarks = process_individual(
+                    body, individuals, individual_tasks)
+                deletes.extend(individual_deletes)
+                updates.extend(individual_updates)
+                watermarks.extend(individual_watermarks)
+                written_ids.extend(body['message_ids'])
+
+            if (target_type == 'ALL'):
+                fan_out_segments(body['message_ids'][0], SWEEP_TOTAL_SEGMENTS)
+
+            if (target_type == 'SEGMENT'):
+                process_segment(body, context)
+        except Exception as e:
+            print(f'failed {body}: {e!r}')
+            failed_groups.update(groups)
+            failed_ids.extend(body['message_ids'])
 
-    print(f'target {target_type}')
     print(f'delete count {len(deletes)}')
     print(f'update count {len(updates)}')
+    print(f'watermark count {len(watermarks)}')
+
+    try:
+        stats = process_updates(deletes, updates, watermarks)
+        print(f'written {stats["written"]} retried {stats["retried"]}')
+    except Exception as e:
+        # Which writes made it isn't known, but they are all safe to repeat so every message that had writes is retried
+        print(f'failed to write updates: {e!r}')
+        failed_ids.extend(written_ids)
+
+    publish_metrics()
 
-    process_updates(deletes)
-    process_updates(updates)
+    failed_ids = list(dict.fromkeys(failed_ids))
+    print(f'failed {len(failed_ids)} of {len(event["Records"])} messages')
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
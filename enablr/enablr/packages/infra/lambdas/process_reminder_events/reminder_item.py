@@ -0,0 +1,57 @@
+import json
+import hashlib
+
+
+def get_task_version(task, tz):
+    '''A short digest of everything that decides a tasks reminders. When it changes the reminders need generating again'''
+    content = json.dumps({'details': task['details'], 'tz': tz},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def create_reminder_item(individual_id, task_id, due, task_version, completed=False):
+    '''A reminder as it is stored. Only the keys, due time, completion and note are kept, plus the version of the task it
+    was made from. Everything else about the task (name, description, times) is read from the individuals record instead
+    of being copied into every reminder, which keeps each item to a single write unit.
+
+    Items written before this still have task_id, individual_id, readable_timestamp and details on them, readers should only
+    rely on the fields here'''
+    reminder_id = f'{individual_id}-{task_id}'
+    item = {
+        "reminder_id": reminder_id,
+        "due": due,
+        "completed": completed,
+        "note": "",
+        "task_version": task_version
+    }
+
+    # Only set while the reminder is pending, it is removed when the reminder is completed
+    if not completed:
+        item["pending_reminder_id"] = reminder_id
+
+    return item
+
+
+def create_day_item(individual_id, task_id, day_start, slots, task_version):
+    '''All of one tasks reminders for one local day packed into a single item, keyed by the timestamp the day starts at.
+    Each slot is a {due, completed, note} map, so marking one reminder complete is an update to just that slot'''
+    return {
+        "reminder_id": f'{individual_id}-{task_id}',
+        "due": day_start,
+        "slots": slots,
+        "task_version": task_version
+    }
+
+
+def create_slot(due):
+    return {"due": due, "completed": False, "note": ""}
+
+
+def merge_slots(existing_slots, desired_dues, now):
+    '''The slots a day should hold once regenerated. Anything already completed or in the past is kept as it is,
+    the rest are replaced by the newly generated times'''
+    kept = [slot for slot in existing_slots if slot['completed'] or int(slot['due']) <= now]
+    kept_dues = {int(slot['due']) for slot in kept}
+
+    slots = kept + [create_slot(due) for due in desired_dues if due not in kept_dues]
+    return sorted(slots, key=lambda slot: int(slot['due']))
@@ -0,0 +1,106 @@
+import os
+import time
+
+import index
+
+# The dead letter queue messages end up on after failing on the reminder queue too many times
+REMINDER_DLQ_URL = os.environ['REMINDER_DLQ_URL']
+# How many messages are handed to the processing code at once. Bigger batches give coalescing more to fold together
+REPLAY_BATCH_SIZE = int(os.environ.get('REPLAY_BATCH_SIZE', '50'))
+# Messages a second to replay at, so a backlog doesn't swamp the tables the apps are using
+REPLAY_RATE = float(os.environ.get('REPLAY_RATE', '20'))
+# Stop taking new batches once there is less than this much time left
+REPLAY_TIME_BUFFER_MS = int(os.environ.get('REPLAY_TIME_BUFFER_MS', '120000'))
+
+
+def receive_batch(batch_size):
+    '''Pull up to batch_size messages off the dead letter queue, 10 at a time (the most receive_message returns).
+    They stay hidden from other readers until deleted, for longer than a batch takes to process'''
+    messages = []
+    while len(messages) < batch_size:
+        response = index.sqs_client.receive_message(
+            QueueUrl=REMINDER_DLQ_URL,
+            MaxNumberOfMessages=min(10, batch_size - len(messages)),
+            AttributeNames=['MessageGroupId'],
+            VisibilityTimeout=900,
+            WaitTimeSeconds=1
+        )
+        received = response.get('Messages', [])
+        if not received:
+            break
+        messages.extend(received)
+
+    return messages
+
+
+def delete_messages(messages):
+    '''Remove messages from the dead letter queue, 10 at a time'''
+    for i in range(0, len(messages), 10):
+        index.sqs_client.delete_message_batch(
+            QueueUrl=REMINDER_DLQ_URL,
+            Entries=[{'Id': str(n), 'ReceiptHandle': message['ReceiptHandle']}
+                     for n, message in enumerate(messages[i:i + 10])]
+        )
+
+
+def replay_batch(messages, context):
+    '''Run a batch through the same handler the reminder queue uses, in the same record format.
+    Returns the ids of the messages that failed again'''
+    records = [{
+        'messageId': message['MessageId'],
+        'body': message['Body'],
+        'attributes': message.get('Attributes', {})
+    } for message in messages]
+
+    response = index.lambda_handler({'Records': records}, context)
+    return {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+
+
+def lambda_handler(event, context):
+    '''Drain the dead letter queue, invoked by hand. The event can override the rate, batch size and a cap on how many messages to replay:
+    {"rate": 20, "batch_size": 50, "max_messages": 1000}'''
+    event = event or {}
+    rate = float(event.get('rate', REPLAY_RATE))
+    batch_size = int(event.get('batch_size', REPLAY_BATCH_SIZE))
+    max_messages = event.get('max_messages')
+
+    started = time.perf_counter()
+    received = 0
+    replayed = 0
+    failed = 0
+
+    while context.get_remaining_time_in_millis() > REPLAY_TIME_BUFFER_MS:
+        if max_messages is not None:
+            batch_size = min(batch_size, max_messages - received)
+            if batch_size <= 0:
+                break
+
+        messages = receive_batch(batch_size)
+        if not messages:
+            break
+        received += len(messages)
+
+        failed_ids = replay_batch(messages, context)
+
+        # Failed messages are left alone, they show up on the queue again once their visibility timeout runs out
+        delete_messages([m for m in messages if m['MessageId'] not in failed_ids])
+        replayed += len(messages) - len(failed_ids)
+        failed += len(failed_ids)
+
+        # Hold back until the average rate is under the limit
+        ahead = received / rate - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+        print(f'replayed {replayed} failed {failed} of {received}')
+
+    seconds = time.perf_counter() - started
+    summary = {
+        'received': received,
+        'replayed': replayed,
+        'failed': failed,
+        'seconds': round(seconds, 1),
+        'per_second': round(received / seconds, 1) if seconds else 0
+    }
+    print(summary)
+    return summary
@@ -0,0 +1,101 @@
+import datetime
+from functools import lru_cache
+
+import numpy as np
+from pytz import timezone
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+@lru_cache(maxsize=512)
+def get_day_origin(tz, now_timestamp, days_ahead=0):
+    '''Get the timestamp of local midnight for a day in a timezone, and the timestamp of now.
+    Today uses the UTC offset in effect at now, which is what replacing the hour/minute on the localized time does.
+    Later days use the offset in effect at midday that day so a daylight savings change in between is picked up'''
+    now = datetime.datetime.fromtimestamp(now_timestamp, timezone(tz))
+    day = now.date() + datetime.timedelta(days=days_ahead)
+
+    if days_ahead == 0:
+        offset = now.utcoffset()
+    else:
+        offset = timezone(tz).localize(datetime.datetime.combine(
+            day, datetime.time(12))).utcoffset()
+
+    midnight = (day.toordinal() - EPOCH_ORDINAL) * 86400 - int(offset.total_seconds())
+    return midnight, now.timestamp()
+
+
+@lru_cache(maxsize=512)
+def get_local_date(tz, now_timestamp, days_ahead=0):
+    '''The local date (yyyy-mm-dd) in a timezone a number of days from now'''
+    now = datetime.datetime.fromtimestamp(now_timestamp, timezone(tz))
+    return (now.date() + datetime.timedelta(days=days_ahead)).isoformat()
+
+
+def get_day_origins(tzs, now_timestamp, days_ahead=0):
+    '''Resolve the midnight and now timestamps for every spec, only doing the timezone work once per timezone'''
+    unique_tzs, inverse = np.unique(np.asarray(tzs, dtype=object).astype(str), return_inverse=True)
+    origins = np.array([get_day_origin(tz, now_timestamp, days_ahead)
+                       for tz in unique_tzs], dtype=np.float64).reshape(-1, 2)
+
+    return origins[inverse, 0].astype(np.int64), origins[inverse, 1]
+
+
+def compile_schedules(specs, current_time, days=1):
+    '''Work out every reminder still to come over the next few days (today included) for many (startTime, endTime, frequency, tz) specs at once.
+    Returns two flat arrays, the index of the spec each reminder belongs to and the reminder timestamp'''
+    if len(specs) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    start_h, start_m, end_h, end_m, frequency, tzs = zip(*[
+        (s['startTime']['h'], s['startTime']['m'], s['endTime']['h'], s['endTime']['m'], s['frequency'], tz)
+        for s, tz in specs])
+
+    start = np.asarray(start_h, dtype=np.int64) * 3600 + np.asarray(start_m, dtype=np.int64) * 60
+    end = np.asarray(end_h, dtype=np.int64) * 3600 + np.asarray(end_m, dtype=np.int64) * 60
+    steps = np.asarray(frequency, dtype=np.int64) - 1
+
+    indexes = []
+    reminders = []
+    for days_ahead in range(days):
+        midnight, now = get_day_origins(
+            tzs, current_time.timestamp(), days_ahead)
+        index, due = compile_day(midnight + start, midnight + end, steps)
+
+        # dont include reminders that have already occurred
+        upcoming = due > now[index]
+        indexes.append(index[upcoming])
+        reminders.append(due[upcoming])
+
+    index = np.concatenate(indexes)
+    due = np.concatenate(reminders)
+
+    # Keep each specs reminders together and in time order
+    order = np.lexsort((due, index))
+    return index[order], due[order]
+
+
+def compile_day(earliest, latest, steps):
+    '''Spread steps + 1 reminders evenly between the earliest and latest timestamps of each spec'''
+
+    # Math stuff below here is summed up as:
+    # If more than one reminder is needed, then work out the distance between reminders and create a reminder for each block
+    # Until the final time has been reached.
+    # The distance is added on one step at a time (rather than multiplied) so the floating point result is identical to the loop this replaced
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = (latest - earliest) / np.maximum(steps, 1).astype(np.float64)
+
+    indexes = [np.arange(len(earliest))]
+    reminders = [earliest]
+
+    travelled = earliest.astype(np.float64)
+    active = steps > 0
+    for step in range(1, int(steps.max(initial=0)) + 1):
+        travelled = travelled + distance
+        active &= (step <= steps) & (travelled <= latest)
+        if not active.any():
+            break
+        indexes.append(np.flatnonzero(active))
+        reminders.append(np.floor(travelled[active]).astype(np.int64))
+
+    return np.concatenate(indexes), np.concatenate(reminders)
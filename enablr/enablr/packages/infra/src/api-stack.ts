@@ -92,6 +92,8 @@ export class APIStack extends Stack {
         loggingLevel: MethodLoggingLevel.INFO,
         tracingEnabled: true,
       },
+      // Gzip any response over 1KB for clients that accept it, mostly so the device bootstrap stays small
+      minimumCompressionSize: 1024,
     });
 
     // Make sure when this is cleaned up the api is removed
@@ -167,6 +169,9 @@ export class APIStack extends Stack {
 
     const lambdaAuthorizer = new TokenAuthorizer(this, "APIGWTokenAuthorizer", {
       handler: authorizer,
+      // The authorizer also checks the registration hasn't been revoked, so its answer is only reused for a short time.
+      // It caches tokens and registrations itself so being called more often is cheap
+      resultsCacheTtl: Duration.seconds(30),
     });
 
     // The device proxy uses a different sort of authorizer validated by a JWT to allow for many devices that don't require a direct login.
@@ -241,6 +246,15 @@ export class APIStack extends Stack {
       billingMode: BillingMode.PAY_PER_REQUEST,
     });
 
+    // A sparse index of reminders that haven't been completed yet. pending_reminder_id is only set while a reminder is pending
+    // so cleanup of outstanding reminders never has to read (and pay for) the completed ones.
+    this.reminderTable.addGlobalSecondaryIndex({
+      indexName: "PendingIndex",
+      partitionKey: { name: "pending_reminder_id", type: AttributeType.STRING },
+      sortKey: { name: "due", type: AttributeType.NUMBER },
+      projectionType: ProjectionType.KEYS_ONLY,
+    });
+
     // Allow the individual API to read from the reminder table. And Write access for modifications.
     this.reminderTable.grantReadWriteData(individualAPI);
     this.reminderTable.grantReadWriteData(deviceAPI);
@@ -293,7 +307,7 @@ export class APIStack extends Stack {
 
     this.deviceTable.grantReadWriteData(individualAPI);
     this.deviceTable.grantReadWriteData(registerAPI);
-    this.deviceTable.grantReadData(deviceAPI);
+    this.deviceTable.grantReadData(authorizer);
 
     //=========== Add in secret values that need to be manually populated
     // So the token can be signed by the registration API
@@ -366,10 +380,12 @@ export class APIStack extends Stack {
       jwtPublicSigningKey.parameterName
     );
 
-    deviceAPI.addEnvironment(
+    // Revocation is checked by the authorizer, the device API gets the individual from its context
+    authorizer.addEnvironment(
       "REGISTRATION_TABLE_NAME",
       this.deviceTable.tableName
     );
+
     deviceAPI.addEnvironment(
       "INDIVIDUAL_TABLE_NAME",
       this.individualTable.tableName
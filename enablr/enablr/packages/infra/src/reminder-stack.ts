@@ -2,11 +2,21 @@
 SPDX-License-Identifier: Apache-2.0 */
 import path from "path";
 import * as lambda from "@aws-cdk/aws-lambda-python-alpha";
-import { Duration, Stack, StackProps } from "aws-cdk-lib";
-import { Table } from "aws-cdk-lib/aws-dynamodb";
+import { Duration, Names, RemovalPolicy, Stack, StackProps } from "aws-cdk-lib";
+import {
+  AttributeType,
+  BillingMode,
+  Table,
+  TableEncryption,
+} from "aws-cdk-lib/aws-dynamodb";
 import { Rule, RuleTargetInput, Schedule } from "aws-cdk-lib/aws-events";
 import * as targets from "aws-cdk-lib/aws-events-targets";
-import { Runtime, StartingPosition } from "aws-cdk-lib/aws-lambda";
+import {
+  CfnEventSourceMapping,
+  EventSourceMapping,
+  Runtime,
+  StartingPosition,
+} from "aws-cdk-lib/aws-lambda";
 import {
   DynamoEventSource,
   SqsEventSource,
@@ -77,15 +87,97 @@ export class ReminderStack extends Stack {
       fifo: true, // Make sure the events are in order
     });
 
-    // Pass in environment variables so they can be accessed by the lambdas
-    processReminderEventLambda.addEnvironment(
-      "INDIVIDUAL_TABLE_NAME",
-      props.individualTable.tableName
+    // The ALL sweep fans out onto this queue, one message per scan segment. It is kept apart from the reminder queue
+    // so it can be read a message at a time, giving each segment an invocation (and a full timeout) to itself
+    const sweepQueue = new Queue(this, "sweepQueue", {
+      queueName: "reminder-sweep-queue.fifo",
+      deadLetterQueue: { queue: reminderDLQ, maxReceiveCount: 3 },
+      contentBasedDeduplication: true,
+      visibilityTimeout: Duration.minutes(15), // Needs to be the same as the lambda runtime
+      fifo: true,
+    });
+
+    // The most invocations each queue can have running at once. Every sweep segment gets one, so the sweep runs in parallel
+    const reminderQueueConcurrency = 4;
+    const sweepConcurrency = 8;
+    // Write units a second reminder processing can use in total, shared out between every invocation that can be running
+    const reminderWriteBudget = 600;
+
+    // Records how far ahead reminders have been generated for each individuals task (keyed by reminder_id)
+    // so the sweep can skip any task that is already covered.
+    const reminderWatermarkTable = new Table(this, "ReminderWatermarkTable", {
+      partitionKey: { name: "reminder_id", type: AttributeType.STRING },
+      removalPolicy: RemovalPolicy.DESTROY,
+      encryption: TableEncryption.AWS_MANAGED,
+      billingMode: BillingMode.PAY_PER_REQUEST,
+    });
+
+    // Drains the dead letter queue back through the same processing code, run by hand after an outage with
+    // aws lambda invoke --function-name <name> --payload '{"rate": 20}'
+    const replayReminderEventLambda = new lambda.PythonFunction(
+      this,
+      "replay_reminder_eventsHandler",
+      {
+        entry: path.join(__dirname, "../lambdas/process_reminder_events"),
+        index: "replay.py",
+        handler: "lambda_handler",
+        runtime: Runtime.PYTHON_3_9,
+        layers: [powertoolsLayer],
+        timeout: Duration.minutes(15),
+        environment: {},
+      }
     );
-    processReminderEventLambda.addEnvironment(
-      "REMINDER_TABLE_NAME",
-      props.reminderTable.tableName
+    replayReminderEventLambda.addEnvironment(
+      "REMINDER_DLQ_URL",
+      reminderDLQ.queueUrl
     );
+    reminderDLQ.grantConsumeMessages(replayReminderEventLambda);
+
+    // The replay lambda runs the same code as the processing lambda so it needs the same environment and access
+    [processReminderEventLambda, replayReminderEventLambda].forEach((fn) => {
+      // Pass in environment variables so they can be accessed by the lambdas
+      fn.addEnvironment(
+        "INDIVIDUAL_TABLE_NAME",
+        props.individualTable.tableName
+      );
+      fn.addEnvironment("REMINDER_TABLE_NAME", props.reminderTable.tableName);
+      fn.addEnvironment("REMINDER_TABLE_PENDING_INDEX_NAME", "PendingIndex");
+      // Pending reminders that predate the index are put in it by scripts/backfill-pending-index.py, run once after upgrading
+      // (see the README). Only set this to "true" for a deployment that hasn't been backfilled yet
+      fn.addEnvironment("REMINDER_UNINDEXED_CLEANUP", "false");
+      fn.addEnvironment(
+        "REMINDER_WATERMARK_TABLE_NAME",
+        reminderWatermarkTable.tableName
+      );
+      // How many days of reminders (today included) are generated ahead. Devices show every pending reminder they are sent,
+      // so raise this once they only ask for the reminders they need.
+      fn.addEnvironment("REMINDER_LOOKAHEAD_DAYS", "1");
+      // "item" stores every reminder as its own item, "day" packs a tasks reminders for a day into one item.
+      // The APIs read both, so this can be switched without migrating anything
+      fn.addEnvironment("REMINDER_STORAGE_MODE", "item");
+      // Set to "true" when switching from "day" back to "item", so task edits clear the pending slots out of the day items left behind.
+      // Back to "false" once REMINDER_LOOKAHEAD_DAYS + 1 days have passed, when every day item left is in the past
+      fn.addEnvironment("REMINDER_DAY_ITEM_CLEANUP", "false");
+
+      fn.addEnvironment("SWEEP_QUEUE_URL", sweepQueue.queueUrl);
+      fn.addEnvironment("SWEEP_TOTAL_SEGMENTS", String(sweepConcurrency));
+      // Write units a second each invocation paces itself under (and backs off from whenever the reminder table throttles).
+      // The ceiling is per invocation, so it is the budget split across the most invocations the queues allow at once.
+      // The replay lambda is run by hand and only one at a time, so it gets the same share on top
+      fn.addEnvironment(
+        "REMINDER_WRITE_WCU_CEILING",
+        String(
+          Math.floor(
+            reminderWriteBudget / (reminderQueueConcurrency + sweepConcurrency)
+          )
+        )
+      );
+
+      sweepQueue.grantSendMessages(fn);
+      props.reminderTable.grantReadWriteData(fn);
+      props.individualTable.grantReadData(fn);
+      reminderWatermarkTable.grantReadWriteData(fn);
+    });
 
     individualEventLambda.addEnvironment(
       "TASK_EVENT_QUEUE_URL",
@@ -100,19 +192,42 @@ export class ReminderStack extends Stack {
     processReminderEventLambda.addEventSource(
       new SqsEventSource(reminderQueue, {
         batchSize: 5,
+        // The handler returns the messages that failed so the rest of the batch isn't redelivered
+        reportBatchItemFailures: true,
       })
     );
 
-    props.reminderTable.grantReadWriteData(processReminderEventLambda);
+    processReminderEventLambda.addEventSource(
+      new SqsEventSource(sweepQueue, {
+        // A segment can take most of the lambda timeout, so never hand one invocation more than one
+        batchSize: 1,
+        reportBatchItemFailures: true,
+      })
+    );
+
+    // This version of the SqsEventSource has no maxConcurrency, so it is set on the mappings it creates
+    [
+      { queue: reminderQueue, maximumConcurrency: reminderQueueConcurrency },
+      { queue: sweepQueue, maximumConcurrency: sweepConcurrency },
+    ].forEach(({ queue, maximumConcurrency }) => {
+      const mapping = processReminderEventLambda.node.findChild(
+        `SqsEventSource:${Names.nodeUniqueId(queue.node)}`
+      ) as EventSourceMapping;
+      (mapping.node.defaultChild as CfnEventSourceMapping).addPropertyOverride(
+        "ScalingConfig.MaximumConcurrency",
+        maximumConcurrency
+      );
+    });
+
     props.reminderTable.grantReadData(processReminderEventLambda);
 
     props.taskTable.grantReadData(processReminderEventLambda);
-    props.individualTable.grantReadData(processReminderEventLambda);
 
     new Rule(this, "dailyRule", {
       schedule: Schedule.cron({ minute: "0", hour: "0/2" }),
       targets: [
         new targets.SqsQueue(reminderQueue, {
+          // Kept apart from the individual-* groups task edits use, so a sweep never waits behind edits or holds them up
           messageGroupId: "scheduled",
           message: RuleTargetInput.fromObject({ target_type: "ALL" }),
         }),
@@ -1,10 +1,18 @@
 import json
 import boto3
 import os
+import sys
 import math
 import datetime
 import random
 from pytz import timezone, utc
+
+# Share the batch writer and reminder item format used by the reminder lambda
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                '../packages/infra/lambdas/process_reminder_events'))
+
+import batch_writer  # noqa: E402
+import reminder_item  # noqa: E402
 #Hellooooooooo
 
 # Charlie
@@ -17,6 +25,7 @@ dynamodb_client = boto3.client('dynamodb')
 individual_table = dynamodb_resource.Table(INDIVIDUAL_TABLE_NAME)
 reminder_table = dynamodb_resource.Table(REMINDER_TABLE_NAME)
 individual_id = INDIVIDUAL_ID
+writer = batch_writer.BatchWriter(reminder_table.name, dynamodb_client)
 
 #dynamodb_resource = boto3.resource('dynamodb')
 #dynamodb_client = boto3.client('dynamodb')
@@ -53,47 +62,16 @@ def delete_remaining_tasks(individual_id, task_id):
     process_updates(deletes)
 
 
-def create_reminder(timestamp, task, target_id, time, completed):
-    task_id = task['task_id']
+def create_reminder(timestamp, task, target_id, task_version, completed):
     return {
         "PutRequest": {
-            "Item": {
-                "reminder_id": f'{target_id}-{task_id}',
-                'task_id': task_id,
-                'individual_id': target_id,
-                "due": timestamp,
-                "readable_timestamp": time,
-                "details": task,
-                "completed": completed,
-                "note": ""
-            }
+            "Item": reminder_item.create_reminder_item(target_id, task['task_id'], timestamp, task_version, completed)
         }
     }
 
 
-def publish_updates(updates):
-    batch_keys = {
-        reminder_table.name: updates
-    }
-
-    response = dynamodb_resource.batch_write_item(
-        RequestItems=batch_keys
-    )
-
-
 def process_updates(updates):
-    count = 0
-    next_updates = []
-    for update in updates:
-        count += 1
-        next_updates.append(update)
-        if count == 25:
-            publish_updates(next_updates)
-            count = 0
-            next_updates = []
-
-    if count > 0:
-        publish_updates(next_updates)
+    writer.write_all(updates)
 
 
 def create_all_reminders(individual, task):
@@ -152,6 +130,8 @@ def create_records(target_id, task, tz, current_time, day_back):
             reminders.append(math.floor(travelled))
             travelled = travelled + distance
 
+    task_version = reminder_item.get_task_version(task, tz)
+
     updates = []
     for reminder in reminders:
         # dont include reminders that have already occurred
@@ -165,7 +145,7 @@ def create_records(target_id, task, tz, current_time, day_back):
         if time.timestamp() > datetime.datetime.now(utc).timestamp() - (60*60*1.5):
             completed = False
         updates.append(create_reminder(
-            reminder, task, target_id, str(time), completed))
+            reminder, task, target_id, task_version, completed))
 
     return updates
 
@@ -191,5 +171,8 @@ def process():
 
         create_all_reminders(individual, task)
 
+    print(writer.stats())
+
 
-process()
+with writer:
+    process()
@@ -0,0 +1,64 @@
+import os
+import math
+import datetime
+import boto3
+from pytz import utc
+
+# Puts reminders written before the pending index existed into it, by setting pending_reminder_id on every
+# reminder still to come that hasn't been completed. Run it once straight after deploying the index to an existing
+# table, until then deleting or editing a task can leave its older reminders behind. It is safe to run again
+#
+# REMINDER_TABLE_NAME=<table> python backfill-pending-index.py
+
+dynamodb_client = boto3.client('dynamodb')
+REMINDER_TABLE_NAME = os.environ['REMINDER_TABLE_NAME']
+
+
+def get_unindexed_reminders(since):
+    '''Yield the keys of every pending reminder due after since that isn't in the pending index'''
+    scan_kwargs = {
+        'TableName': REMINDER_TABLE_NAME,
+        'FilterExpression': 'due > :due AND completed = :completed AND attribute_not_exists(pending_reminder_id)',
+        'ProjectionExpression': 'reminder_id, due',
+        'ExpressionAttributeValues': {
+            ':due': {'N': str(since)},
+            ':completed': {'BOOL': False}
+        }
+    }
+
+    while True:
+        response = dynamodb_client.scan(**scan_kwargs)
+        yield from response['Items']
+
+        if 'LastEvaluatedKey' not in response:
+            return
+
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def backfill():
+    since = math.floor(datetime.datetime.now(utc).timestamp())
+
+    updated = 0
+    skipped = 0
+    for key in get_unindexed_reminders(since):
+        try:
+            # The condition stops a reminder deleted or completed since the scan being brought back or put in the index
+            dynamodb_client.update_item(
+                TableName=REMINDER_TABLE_NAME,
+                Key=key,
+                UpdateExpression='SET pending_reminder_id = :reminder_id',
+                ConditionExpression='attribute_exists(reminder_id) AND completed = :completed',
+                ExpressionAttributeValues={
+                    ':reminder_id': key['reminder_id'],
+                    ':completed': {'BOOL': False}
+                }
+            )
+            updated += 1
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            skipped += 1
+
+    print(f'indexed {updated} reminders, skipped {skipped}')
+
+
+backfill()
@@ -0,0 +1,87 @@
+import os
+import sys
+import math
+import time
+import random
+import datetime
+from pytz import timezone, utc
+
+# The schedule compiler lives with the lambda that uses it
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                '../packages/infra/lambdas/process_reminder_events'))
+
+import schedule  # noqa: E402
+
+TIMEZONES = ['Australia/Melbourne', 'Australia/Perth', 'Australia/Adelaide',
+             'Australia/Brisbane', 'Australia/Darwin', 'Pacific/Auckland', 'UTC']
+
+
+def create_timestamps(task, tz, current_time):
+    '''The per task loop create_records used before the schedule compiler. Kept here to check the results match exactly'''
+    start_time = task['startTime']
+    end_time = task['endTime']
+
+    timezone_time = current_time.astimezone(timezone(tz))
+    earliest_time = timezone_time.replace(
+        day=timezone_time.day,
+        hour=start_time["h"], minute=start_time["m"], second=0, microsecond=0)
+
+    latest_time = timezone_time.replace(day=timezone_time.day,
+                                        hour=end_time["h"], minute=end_time["m"], second=0, microsecond=0)
+
+    frequency = task['frequency'] - 1
+
+    reminders = [math.floor(earliest_time.timestamp())]
+
+    if frequency > 0:
+        distance = (latest_time.timestamp() -
+                    earliest_time.timestamp())/float(frequency)
+
+        travelled = earliest_time.timestamp() + distance
+
+        while travelled <= latest_time.timestamp():
+            reminders.append(math.floor(travelled))
+            travelled = travelled + distance
+
+    return [r for r in reminders if r > timezone_time.timestamp()]
+
+
+def random_spec():
+    # The end time is always after the start time, the old loop never finishes otherwise
+    start = random.randrange(0, 23 * 60)
+    end = random.randrange(start + 1, 24 * 60)
+    return ({
+        'startTime': {'h': start // 60, 'm': start % 60},
+        'endTime': {'h': end // 60, 'm': end % 60},
+        'frequency': random.randrange(1, 10)
+    }, random.choice(TIMEZONES))
+
+
+def run(count, current_time):
+    specs = [random_spec() for _ in range(count)]
+
+    started = time.perf_counter()
+    expected = [create_timestamps(task, tz, current_time) for task, tz in specs]
+    loop_seconds = time.perf_counter() - started
+
+    schedule.get_day_origin.cache_clear()
+    started = time.perf_counter()
+    index, due = schedule.compile_schedules(specs, current_time)
+    compiled_seconds = time.perf_counter() - started
+
+    actual = [[] for _ in specs]
+    for i, reminder in zip(index.tolist(), due.tolist()):
+        actual[i].append(reminder)
+
+    if actual != expected:
+        raise Exception(f'Compiled schedule does not match for {count} specs')
+
+    print(f'{count} specs, {len(due)} reminders')
+    print(f'  loop     {loop_seconds:.3f}s  {count / loop_seconds:,.0f} specs/s')
+    print(f'  compiled {compiled_seconds:.3f}s  {count / compiled_seconds:,.0f} specs/s')
+
+
+random.seed(1)
+now = datetime.datetime.now(utc)
+for count in [10000, 100000]:
+    run(count, now)